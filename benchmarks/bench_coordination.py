@@ -0,0 +1,16 @@
+import os
+
+from bitbox.coordination import intra_person_coordination
+
+from . import common
+
+
+class IntraPersonCoordination(common._Benchmark):
+    params = (common.SIZES, sorted({1, os.cpu_count() or 1}))
+    param_names = ['frames', 'n_jobs']
+
+    def setup(self, num_frames, n_jobs):
+        self.expression = common.read_data('expression_localized', num_frames)
+
+    def run(self, num_frames, n_jobs):
+        intra_person_coordination(self.expression, width=0.5, fps=common.FPS, n_jobs=n_jobs)
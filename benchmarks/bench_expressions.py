@@ -0,0 +1,47 @@
+from bitbox.expressions import asymmetry, expressivity, diversity, compute_all
+
+from . import common
+
+
+class Asymmetry(common._Benchmark):
+    params = common.SIZES
+    param_names = ['frames']
+
+    def setup(self, num_frames):
+        self.landmarks = common.read_data('landmarks_canonicalized', num_frames)
+
+    def run(self, num_frames):
+        asymmetry(self.landmarks)
+
+
+class Expressivity(common._Benchmark):
+    params = (common.SIZES, ['expression_localized', 'expression_smooth'])
+    param_names = ['frames', 'output']
+
+    def setup(self, num_frames, output):
+        self.expression = common.read_data(output, num_frames)
+
+    def run(self, num_frames, output):
+        expressivity(self.expression, fps=common.FPS)
+
+
+class Diversity(common._Benchmark):
+    params = (common.SIZES, ['expression_localized', 'expression_smooth'])
+    param_names = ['frames', 'output']
+
+    def setup(self, num_frames, output):
+        self.expression = common.read_data(output, num_frames)
+
+    def run(self, num_frames, output):
+        diversity(self.expression, fps=common.FPS)
+
+
+class ComputeAll(common._Benchmark):
+    params = (common.SIZES, ['expression_localized', 'expression_smooth'])
+    param_names = ['frames', 'output']
+
+    def setup(self, num_frames, output):
+        self.expression = common.read_data(output, num_frames)
+
+    def run(self, num_frames, output):
+        compute_all(self.expression, fps=common.FPS)
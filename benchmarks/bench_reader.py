@@ -0,0 +1,17 @@
+from . import common
+
+
+class ReadOutputs(common._Benchmark):
+    # text: parsing the .3DI file, binary: memory-mapping its binary copy (and reading all values)
+    params = (common.SIZES, list(common.OUTPUTS.keys()), ['text', 'binary'])
+    param_names = ['frames', 'output', 'mode']
+
+    def setup(self, num_frames, output, mode):
+        self.reader = common.OUTPUTS[output][0]
+        self.file = common.data_file(output, num_frames)
+        if mode == 'binary':
+            self.reader(self.file)
+
+    def run(self, num_frames, output, mode):
+        data = self.reader(self.file, binary=mode == 'binary')
+        data.values.sum()
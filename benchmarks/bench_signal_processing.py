@@ -0,0 +1,28 @@
+from bitbox.signal_processing import peak_detection, windowed_cross_correlation
+
+from . import common
+
+
+class PeakDetection(common._Benchmark):
+    # a single signal and all localized expression coefficients at once
+    params = (common.SIZES, ['single', 'all'])
+    param_names = ['frames', 'signals']
+
+    def setup(self, num_frames, signals):
+        self.data = common.read_data('expression_localized', num_frames).values
+        if signals == 'single':
+            self.data = self.data[:, 0].copy()
+
+    def run(self, num_frames, signals):
+        peak_detection(self.data, num_scales=6, fps=common.FPS, smooth=True)
+
+
+class WindowedCrossCorrelation(common._Benchmark):
+    params = common.SIZES
+    param_names = ['frames']
+
+    def setup(self, num_frames):
+        self.data = common.read_data('expression_localized', num_frames).values
+
+    def run(self, num_frames):
+        windowed_cross_correlation(self.data, self.data, width=0.5, fps=common.FPS, symmetric=True)
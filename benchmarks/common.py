@@ -0,0 +1,107 @@
+import os
+import time
+import tempfile
+
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+
+from bitbox.face_backend.reader3DI import read_rectangles, read_landmarks, read_pose, read_expression, read_canonical_landmarks
+
+
+# Synthetic 3DI outputs are written once for each number of frames and reused by all benchmarks (and runs).
+# Set BITBOX_BENCHMARK_DATA to keep them somewhere other than the temporary directory.
+DATA_DIR = os.environ.get('BITBOX_BENCHMARK_DATA', os.path.join(tempfile.gettempdir(), 'bitbox-benchmarks'))
+
+FPS = 30
+NUM_LANDMARKS = 51
+
+# number of frames, 1M frames is about 9 hours of video
+SIZES = [1000, 100000, 1000000]
+
+# (reader, number of columns of the .3DI file) of each output
+OUTPUTS = {'rects': (read_rectangles, 4),
+           'landmarks': (read_landmarks, 2*NUM_LANDMARKS),
+           'pose_smooth': (read_pose, 9),
+           'expression_smooth': (read_expression, 79),
+           'expression_localized': (read_expression, 32),
+           'landmarks_canonicalized': (read_canonical_landmarks, 3*NUM_LANDMARKS)}
+
+# frames generated (and written) at once, keeps the memory bounded for long recordings
+_BLOCK_FRAMES = 50000
+
+
+def _signals(rng, num_frames, num_signals, scale=1.0, sigma=3):
+    # smooth random signals with peaks at different scales, similar to expression coefficients
+    return scale * sigma * gaussian_filter1d(rng.standard_normal((num_frames, num_signals)), sigma, axis=0)
+
+
+def _face(rng, dimension):
+    # a fixed face shape, roughly in millimeters
+    return rng.uniform(-60, 60, size=(NUM_LANDMARKS, dimension))
+
+
+def _block(output, rng, num_frames):
+    if output == 'rects':
+        return np.tile([100, 80, 240, 240], (num_frames, 1)) + _signals(rng, num_frames, 4, scale=2)
+    if output == 'landmarks':
+        face = _face(np.random.default_rng(0), 2) + [320, 240]
+        return face.reshape(-1) + _signals(rng, num_frames, 2*NUM_LANDMARKS)
+    if output == 'pose_smooth':
+        return np.concatenate((_signals(rng, num_frames, 3, scale=5) + [0, 0, 600],
+                               np.zeros((num_frames, 3)),
+                               _signals(rng, num_frames, 3, scale=0.05)), axis=1)
+    if output == 'landmarks_canonicalized':
+        face = _face(np.random.default_rng(0), 3)
+        return face.reshape(-1) + _signals(rng, num_frames, 3*NUM_LANDMARKS, scale=0.5)
+
+    return _signals(rng, num_frames, OUTPUTS[output][1])
+
+
+def data_file(output, num_frames):
+    # path of the synthetic .3DI file, written if it does not exist yet
+    file = os.path.join(DATA_DIR, '%d' % num_frames, 'synthetic_%s.3DI' % output)
+    if os.path.exists(file):
+        return file
+
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    rng = np.random.default_rng(num_frames)
+
+    # write to a temporary file first so that an interrupted run does not leave a truncated file
+    tmp_file = '%s.%d.tmp' % (file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        for start in range(0, num_frames, _BLOCK_FRAMES):
+            np.savetxt(f, _block(output, rng, min(_BLOCK_FRAMES, num_frames-start)), fmt='%.4f')
+    os.replace(tmp_file, file)
+
+    return file
+
+
+def read_data(output, num_frames):
+    # output as returned by the reader but with the values in memory, so that benchmarks of the analysis
+    # functions do not measure disk reads
+    reader = OUTPUTS[output][0]
+    data = reader(data_file(output, num_frames))
+    data.values = np.array(data.values)
+
+    return data
+
+
+class _Benchmark:
+    # Base of the benchmarks of a function on recordings of different lengths, private so that asv does not
+    # collect it. Subclasses set params (the first one is the number of frames) and implement run() with the
+    # same parameters.
+    timeout = 1800
+
+    def time_run(self, num_frames, *params):
+        self.run(num_frames, *params)
+
+    def peakmem_run(self, num_frames, *params):
+        self.run(num_frames, *params)
+
+    def track_frames_per_second(self, num_frames, *params):
+        start = time.perf_counter()
+        self.run(num_frames, *params)
+        return num_frames / (time.perf_counter() - start)
+
+    track_frames_per_second.unit = 'frames/s'
+
@@ -1,69 +1,380 @@
 from .signal_processing import  windowed_cross_correlation, windowed_cross_correlation_2S
-from .utilities import get_data_values
+from .signal_processing.similarity import window_parameters, _windowed_cross_correlation, _window_blocks, _rolling_windows, _rolling_xcorr, _max_xcorr
+from .utilities import get_data_values, is_stream
+from .profiling import profiled
 
+import os
+import itertools
 import numpy as np
 
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 
-def intra_person_coordination(data, axis=0, width=0.5, lag=None, step=None, fps=30):
+
+# Pairs of signals are processed in blocks of rows of the coordination matrix. The blocks do not depend
+# on the number of workers, so that the results are identical whatever the number of workers is.
+_BLOCK_ROWS = 16
+
+def _row_blocks(num_signals):
+    return [np.arange(i, min(i+_BLOCK_ROWS, num_signals)) for i in range(0, num_signals, _BLOCK_ROWS)]
+
+
+# the signals are shared with the worker processes through shared memory instead of being pickled
+_shared = {}
+
+def _attach_shared(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    _shared['shm'] = shm
+    _shared['data'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    
+    
+def _run_shared_block(func, rows, kwargs):
+    return func(_shared['data'], rows, kwargs)
+
+
+def _run_blocks(func, data, blocks, kwargs, n_jobs=1):
+    # run func(data, rows, kwargs) for each block of rows, on n_jobs processes (-1: all cores)
+    if n_jobs is None or n_jobs == 0 or n_jobs < -1:
+        raise ValueError("n_jobs must be a positive integer or -1.")
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = min(n_jobs, len(blocks))
+        
+    if n_jobs <= 1:
+        return [func(data, rows, kwargs) for rows in blocks]
+    
+    shm = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+    try:
+        shared = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+        shared[:] = data
+        del shared
+        
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_attach_shared, initargs=(shm.name, data.shape, data.dtype.str)) as pool:
+            results = list(pool.map(_run_shared_block, [func]*len(blocks), blocks, [kwargs]*len(blocks)))
+    finally:
+        shm.close()
+        shm.unlink()
+        
+    return results
+
+
+def _coordination_block(data, rows, kwargs):
+    # statistics of the pairs (i, j) for i in rows and all j
+    num_signals = data.shape[1]
+    if len(rows) == num_signals: # the signals are correlated with themselves, windows are normalized once
+        corrs, lags = _windowed_cross_correlation(data, data, symmetric=True, **kwargs)
+    else:
+        corrs, lags = _windowed_cross_correlation(data[:, rows], data, **kwargs)
+    corrs = corrs.reshape((corrs.shape[0], len(rows), num_signals))
+    lags = lags.reshape((lags.shape[0], len(rows), num_signals))
+    
+    # pairs of a signal with itself are not computed
+    corrs[:, np.arange(len(rows)), rows] = 0
+    lags[:, np.arange(len(rows)), rows] = 0
+    
+    return corrs.mean(axis=0), lags.mean(axis=0), corrs.std(axis=0)
+
+
+def _merge_moments(count, mean, m2, values):
+    # running means and sums of squared deviations of count values (along the last axis), updated with the
+    # values of a new block
+    num_values = values.shape[-1]
+    block_mean = np.mean(values, axis=-1)
+    block_m2 = np.sum((values - block_mean[..., None])**2, axis=-1)
+    if count == 0:
+        return block_mean, block_m2
+    
+    n = count + num_values
+    delta = block_mean - mean
+    
+    return mean + delta * num_values / n, m2 + block_m2 + delta**2 * count * num_values / n
+
+
+def _coordination_block_2S(data, rows, kwargs):
+    # statistics of the pairs (i, j) for i in rows and j > i
+    num_signals = data.shape[1]
+    corr_mean = np.zeros((len(rows), num_signals))
+    corr_std = np.zeros((len(rows), num_signals))
+    
+    if kwargs['engine'] != 'rolling':
+        for k, i in enumerate(rows):
+            for j in range(i+1, num_signals):
+                # calculate the windowed cross-correlation
+                corrs = windowed_cross_correlation_2S(data[:,i], data[:,j], **kwargs)
+                
+                # calculate the average correlation
+                corr_mean[k,j] = np.mean(corrs)
+                corr_std[k,j] = np.std(corrs)
+                
+        return corr_mean, corr_std
+    
+    # The windows of the signals are shared between the pairs. They are built for a block of windows (and
+    # their lags) at a time, and the mean and std of the correlations are accumulated block by block.
+    width, lag, step = window_parameters(kwargs['width'], kwargs['lag'], kwargs['step'], kwargs['fps'])
+    offsets = np.arange(0, data.shape[0]-width, step)
+    if len(offsets) == 0:
+        corr_mean[np.arange(num_signals)[None, :] > rows[:, None]] = np.nan
+        corr_std[np.arange(num_signals)[None, :] > rows[:, None]] = np.nan
+        return corr_mean, corr_std
+    
+    for b0, b1, first, last in _window_blocks(offsets, step, width, lag, data.shape[0], num_signals=num_signals-rows[0]):
+        # windows (signals, windows, width) of the signals rows[0], ..., num_signals-1
+        windows = np.stack([_rolling_windows(data[:,i], width, kwargs['ordinal'], np.arange(first, last)) for i in range(rows[0], num_signals)])
+        block = offsets[b0:b1]
+        
+        # pairs (i, j) with j > i, all j at once
+        for k, i in enumerate(rows):
+            if i+1 == num_signals:
+                continue
+            baseline = windows[i-rows[0]][block - first]
+            corrs = _max_xcorr(_rolling_xcorr(baseline, windows[i+1-rows[0]:], first, block, width, lag, data.shape[0]))
+            corr_mean[k,i+1:], corr_std[k,i+1:] = _merge_moments(b0, corr_mean[k,i+1:], corr_std[k,i+1:], corrs)
+    
+    # corr_std holds the sums of squared deviations so far
+    corr_std = np.sqrt(corr_std / len(offsets))
+            
+    return corr_mean, corr_std
+
+
+def _stream_values(chunks, axis=0):
+    for chunk in chunks:
+        values = get_data_values(chunk)
+        
+        # whether rows are time points (axis=0) or signals (axis=1)
+        if axis == 1:
+            values = values.T
+            
+        yield values
+        
+        
+def _stream_segments(chunks, width, step):
+    # Join the incoming chunks and yield consecutive segments such that the windows (of width frames,
+    # starting every step frames) of each segment continue the windows of the entire stream. A window
+    # is yielded as soon as the frame after it is received, which is the condition used by
+    # windowed_cross_correlation for the last window.
+    buffer = None
+    for values in chunks:
+        buffer = values if buffer is None else np.concatenate((buffer, values))
+        
+        num_windows = len(range(0, buffer.shape[0]-width, step))
+        if num_windows > 0:
+            yield buffer[:(num_windows-1)*step+width+1]
+            buffer = buffer[num_windows*step:]
+
+
+def _stream_statistics(results):
+    # mean and std of the correlations and mean of the lags over all windows, from running sums over
+    # the (corrs, lags) of consecutive segments
+    num_windows = 0
+    corr_sum = corr_sum2 = lag_sum = None
+    for corrs, lags in results:
+        if corr_sum is None:
+            corr_sum = np.zeros(corrs.shape[1])
+            corr_sum2 = np.zeros(corrs.shape[1])
+            lag_sum = np.zeros(corrs.shape[1])
+            
+        num_windows += corrs.shape[0]
+        corr_sum += corrs.sum(axis=0)
+        corr_sum2 += (corrs**2).sum(axis=0)
+        lag_sum += lags.sum(axis=0)
+        
+    if num_windows == 0:
+        raise ValueError("Signals are too short for the selected window width.")
+    
+    corr_mean = corr_sum / num_windows
+    corr_std = np.sqrt(np.maximum(corr_sum2 / num_windows - corr_mean**2, 0))
+    corr_lag = lag_sum / num_windows
+    
+    return corr_mean, corr_lag, corr_std
+
+
+def _intra_person_coordination_stream(chunks, axis, width, lag, step, fps):
+    width_frames, _, step_frames = window_parameters(width, lag, step, fps)
+    
+    segments = _stream_segments(_stream_values(chunks, axis), width_frames, step_frames)
+    results = (windowed_cross_correlation(segment, segment, width=width, lag=lag, step=step, fps=fps, symmetric=True) for segment in segments)
+    corr_mean, corr_lag, corr_std = _stream_statistics(results)
+    
+    num_signals = int(round(np.sqrt(len(corr_mean))))
+    
+    return corr_mean.reshape((num_signals, num_signals)), corr_lag.reshape((num_signals, num_signals)), corr_std.reshape((num_signals, num_signals))
+
+
+@profiled
+def intra_person_coordination(data, axis=0, width=0.5, lag=None, step=None, fps=30, n_jobs=1):
+    # data can also be a stream of chunks (e.g., reader3DI.iter_expression), which is processed chunk by chunk
+    # n_jobs: number of processes the pairs of signals are distributed to (-1: all cores), only used for
+    #         data in memory
+    if is_stream(data):
+        return _intra_person_coordination_stream(data, axis, width, lag, step, fps)
+    
     # make sure data is in the right format
     data = get_data_values(data)
     
     # whether rows are time points (axis=0) or signals (axis=1)
     if axis == 1:
         data = data.T
-        
-    num_signals = data.shape[1]
-    
-    corr_mean = np.zeros((num_signals, num_signals))
-    corr_std = np.zeros((num_signals, num_signals))
-    corr_lag = np.zeros((num_signals, num_signals))
+    data = np.ascontiguousarray(data, dtype=float)
     
-    corrs, lags = windowed_cross_correlation(data, data, width=width, lag=lag, step=step)
+    # calculate the average correlation and lag of all pairs, block by block
+    kwargs = {'width': width, 'lag': lag, 'step': step, 'fps': fps}
+    results = _run_blocks(_coordination_block, data, _row_blocks(data.shape[1]), kwargs, n_jobs=n_jobs)
     
-    pairs = [(i1, i2) for i1 in range(num_signals) for i2 in range(num_signals)]
-    
-    # calculate the average correlation and lag
-    for idx in range(corrs.shape[1]):
-        i, j = pairs[idx]
-        corr_mean[i,j] = corrs[:,idx].mean()
-        corr_std[i,j] = corrs[:,idx].std()
-        corr_lag[i,j] = lags[:,idx].mean()
+    corr_mean = np.vstack([r[0] for r in results])
+    corr_lag = np.vstack([r[1] for r in results])
+    corr_std = np.vstack([r[2] for r in results])
             
     return corr_mean, corr_lag, corr_std
 
 
-def intra_person_coordination_2S(data, axis=0, width=0.5, lag=None, step=None, fps=30, ordinal=False):
+@profiled
+def intra_person_coordination_2S(data, axis=0, width=0.5, lag=None, step=None, fps=30, ordinal=False, engine='rolling', n_jobs=1):
     # make sure data is in the right format
     data = get_data_values(data)
     
     # whether rows are time points (axis=0) or signals (axis=1)
     if axis == 1:
         data = data.T
+    data = np.ascontiguousarray(data, dtype=float)
         
     num_signals = data.shape[1]
     
-    corr_mean = np.zeros((num_signals, num_signals))
-    corr_std = np.zeros((num_signals, num_signals))
+    # each pair is computed independently, so a single process handles all pairs at once and shares
+    # the windows of each signal between them
+    if n_jobs == 1:
+        blocks = [np.arange(num_signals)]
+    else:
+        blocks = _row_blocks(num_signals)
     
-    # for each pair of signals
-    for i in range(num_signals-1):
-        for j in range(i+1, num_signals):
-            print(i, j)
-            
-            x = data[:,i]
-            y = data[:,j]
-            
-            # calculate the windowed cross-correlation
-            corrs = windowed_cross_correlation_2S(x, y, width=width, lag=lag, step=step, ordinal=ordinal)
-            
-            # calculate the average correlation
-            corr_mean[i,j] = corr_mean[j,i] = np.mean(corrs)
-            corr_std[i,j] = corr_std[j,i] = np.std(corrs)
+    kwargs = {'width': width, 'lag': lag, 'step': step, 'fps': fps, 'ordinal': ordinal, 'engine': engine}
+    results = _run_blocks(_coordination_block_2S, data, blocks, kwargs, n_jobs=n_jobs)
+    
+    # only the pairs (i, j) with i < j are computed, the matrices are symmetric
+    corr_mean = np.vstack([r[0] for r in results])
+    corr_std = np.vstack([r[1] for r in results])
+    corr_mean = corr_mean + corr_mean.T
+    corr_std = corr_std + corr_std.T
             
     return corr_mean, corr_std
 
 
+def _skip_frames(chunks, num_frames):
+    for values in chunks:
+        if num_frames >= values.shape[0]:
+            num_frames -= values.shape[0]
+            continue
+        
+        yield values[num_frames:]
+        num_frames = 0
+        
+        
+def _aligned_chunks(chunks_a, chunks_b):
+    # Join the frames of two people into chunks of shape (frames, signals of a + signals of b). Chunks of
+    # the two streams can have different lengths; frames are yielded as soon as both people have them,
+    # and the stream ends with the shorter one.
+    chunks_a = iter(chunks_a)
+    chunks_b = iter(chunks_b)
+    buffer_a = buffer_b = None
+    while True:
+        try:
+            while buffer_a is None or buffer_a.shape[0] == 0:
+                buffer_a = next(chunks_a)
+            while buffer_b is None or buffer_b.shape[0] == 0:
+                buffer_b = next(chunks_b)
+        except StopIteration:
+            return
+        
+        n = min(buffer_a.shape[0], buffer_b.shape[0])
+        yield np.hstack((buffer_a[:n], buffer_b[:n]))
+        buffer_a = buffer_a[n:]
+        buffer_b = buffer_b[n:]
 
 
-            
-            
\ No newline at end of file
+def _dyadic_correlations(segment, num_a, width, lag, step, fps):
+    # Windowed lagged correlations of each signal of a (first num_a columns) with each signal of b, in
+    # both directions. For each window and pair, the direction with the higher correlation is kept and the
+    # lag is signed: positive when b follows a, negative when a follows b.
+    A = segment[:, :num_a]
+    B = segment[:, num_a:]
+    num_b = B.shape[1]
+    width_frames = window_parameters(width, lag, step, fps)[0]
+    
+    # b leads, a follows
+    corr_ab, lag_ab = _windowed_cross_correlation(A, B, width=width, lag=lag, step=step, fps=fps)
+    # a leads, b follows
+    corr_ba, lag_ba = _windowed_cross_correlation(B, A, width=width, lag=lag, step=step, fps=fps)
+    corr_ba = corr_ba.reshape((-1, num_b, num_a)).transpose(0, 2, 1).reshape((-1, num_a*num_b))
+    lag_ba = lag_ba.reshape((-1, num_b, num_a)).transpose(0, 2, 1).reshape((-1, num_a*num_b))
+    
+    # lags in frames (windowed_cross_correlation reports them relative to the middle of the window)
+    shift = round(width_frames / 2) - (width_frames - 1)
+    frames_ab = np.round(lag_ab * fps) + shift
+    frames_ba = np.round(lag_ba * fps) + shift
+    
+    use_ba = corr_ba > corr_ab
+    corrs = np.where(use_ba, corr_ba, corr_ab)
+    lags = np.where(use_ba, frames_ba, -frames_ab) / fps
+    
+    return corrs, lags
+
+
+@profiled
+def inter_person_coordination(person_a, person_b, axis=0, width=0.5, lag=None, step=None, fps=30, offset=0):
+    # Coordination between the signals (e.g., expressions) of two people, e.g., in a conversation.
+    # For each pair (signal i of person_a, signal j of person_b), windowed cross-correlations are computed
+    # in both directions within the maximum lag. Returned matrices have shape (signals of a, signals of b):
+    # corr_mean, corr_std: mean and std of the maximum correlation over windows
+    # corr_lag: mean lag (in seconds) of the maximum correlation, positive when person_b follows person_a
+    #
+    # person_a and person_b can also be streams of chunks (e.g., reader3DI.iter_expression), which are
+    # processed incrementally so that long sessions do not need to be loaded at once.
+    # The two recordings are aligned at their first frames and analyzed as long as both have frames.
+    # offset: time (in seconds) by which the recording of person_b starts after the recording of person_a
+    #         (negative if it starts before). The first frames of the earlier recording are skipped.
+    skip = int(round(offset*fps))
+    skip_a, skip_b = max(skip, 0), max(-skip, 0)
+    
+    if is_stream(person_a) or is_stream(person_b):
+        chunks_a = person_a if is_stream(person_a) else [person_a]
+        chunks_b = person_b if is_stream(person_b) else [person_b]
+        chunks_a = _skip_frames(_stream_values(chunks_a, axis), skip_a)
+        chunks_b = _skip_frames(_stream_values(chunks_b, axis), skip_b)
+        
+        # the number of signals of person_a is needed to split the aligned chunks
+        first = next(chunks_a, None)
+        if first is None:
+            raise ValueError("Signals are too short for the selected window width.")
+        num_a = first.shape[1]
+        chunks_a = itertools.chain([first], chunks_a)
+        
+        width_frames, _, step_frames = window_parameters(width, lag, step, fps)
+        segments = _stream_segments(_aligned_chunks(chunks_a, chunks_b), width_frames, step_frames)
+        results = (_dyadic_correlations(segment, num_a, width, lag, step, fps) for segment in segments)
+        corr_mean, corr_lag, corr_std = _stream_statistics(results)
+    else:
+        # make sure data is in the right format
+        data_a = get_data_values(person_a)
+        data_b = get_data_values(person_b)
+        
+        # whether rows are time points (axis=0) or signals (axis=1)
+        if axis == 1:
+            data_a = data_a.T
+            data_b = data_b.T
+        
+        # align the two recordings
+        data_a = data_a[skip_a:]
+        data_b = data_b[skip_b:]
+        T = min(data_a.shape[0], data_b.shape[0])
+        num_a = data_a.shape[1]
+        
+        corrs, lags = _dyadic_correlations(np.hstack((data_a[:T], data_b[:T])), num_a, width, lag, step, fps)
+        if corrs.shape[0] == 0:
+            raise ValueError("Signals are too short for the selected window width.")
+        
+        corr_mean = corrs.mean(axis=0)
+        corr_std = corrs.std(axis=0)
+        corr_lag = lags.mean(axis=0)
+        
+    num_b = len(corr_mean) // num_a
+    
+    return corr_mean.reshape((num_a, num_b)), corr_lag.reshape((num_a, num_b)), corr_std.reshape((num_a, num_b))
@@ -1,11 +1,37 @@
-from .utilities import get_data_values
-from .signal_processing import peak_detection, outlier_detectionIQR, log_transform
+from .utilities import get_data_values, is_stream
+from .signal_processing import peak_detection, log_transform
 from .utilities import landmark_to_feature_mapper
+from .profiling import profiled
+import logging
 import numpy as np
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
 # Calculate asymmetry scores using mirror error approach
-def asymmetry(landmarks, axis=0):
+# frames: optional list of frame ids (rows) for which the scores are computed, all frames if None
+@profiled
+def asymmetry(landmarks, axis=0, frames=None):
+    # landmarks can also be a stream of chunks (e.g., reader3DI.iter_canonical_landmarks)
+    if is_stream(landmarks):
+        scores = []
+        for chunk in landmarks:
+            if frames is None:
+                scores.append(asymmetry(chunk, axis=axis))
+                continue
+            
+            # frame ids are global, each chunk knows its first frame
+            first = chunk.get('first frame', 0)
+            num_frames = get_data_values(chunk).shape[1 if axis == 1 else 0]
+            _frames = [f - first for f in frames if first <= f < first + num_frames]
+            if len(_frames) > 0:
+                _scores = asymmetry(chunk, axis=axis, frames=_frames)
+                _scores.index = _scores.index + first
+                scores.append(_scores)
+        if len(scores) == 0:
+            raise ValueError("No landmarks are provided.")
+        return pd.concat(scores, ignore_index=frames is None)
+    
     # read actual values
     data = get_data_values(landmarks)
     
@@ -16,6 +42,15 @@ def asymmetry(landmarks, axis=0):
     dimension = landmarks['dimension']
     schema = landmarks['schema']
     
+    if data.shape[1] % dimension != 0:
+        raise ValueError(f"Landmarks are not {dimension} dimensional. Please set the correct dimension.")
+    
+    if frames is not None:
+        frames = np.asarray(frames, dtype=int).reshape(-1)
+        if np.any(frames < 0) or np.any(frames >= data.shape[0]):
+            raise ValueError("Frame ids must be between 0 and %d." % (data.shape[0]-1))
+        data = data[frames, :]
+    
     rel_ids = landmark_to_feature_mapper(schema=schema)
     rel_ids_mirrored = landmark_to_feature_mapper(schema=schema+'_mirrored')
     
@@ -32,204 +67,229 @@ def asymmetry(landmarks, axis=0):
         'mouth': np.concatenate((rel_ids_mirrored['ul'], rel_ids_mirrored['ll']))
     }
 
-    mirror_mx = np.eye(dimension)
-    mirror_mx[0,0] = -1
+    # mirroring flips the sign of the x coordinates
+    mirror = np.ones(dimension)
+    mirror[0] = -1
     
+    # (frames, landmarks, dimension)
     T = data.shape[0]
+    coords = np.asarray(data).reshape((T, -1, dimension))
     
-    # for each frame, compute asymmetry scores for each feature
+    # compute the mirrored error of each feature for all frames at once
     asymmetry_scores = np.full((T, len(feature_idx.keys())+1), np.nan)
-    
-    for t in range(T):
-        coords = data[t, :]
-        
-        if len(coords) % dimension != 0:
-            raise ValueError(f"Landmarks are not {dimension} dimensional. Please set the correct dimension.")
+    for i, feat in enumerate(feature_idx.keys()):
+        x = coords[:, feature_idx[feat], :]
+        y = coords[:, feature_idx_mirrored[feat], :] * mirror
         
-        num_landmarks = int(len(coords) / dimension)
-        coords = coords.reshape((num_landmarks, dimension))
-
-        # Compute mirrored error for each feature
-        for i, feat in enumerate(feature_idx.keys()):
-            x = coords[feature_idx[feat], :]
-            y = coords[feature_idx_mirrored[feat], :]@mirror_mx
-            
-            score = np.mean(np.sqrt(np.sum((x-y)**2, axis=1)))
-            asymmetry_scores[t, i] = score
-        asymmetry_scores[t, -1] = np.mean(asymmetry_scores[t, 0:-1])
+        asymmetry_scores[:, i] = np.mean(np.sqrt(np.sum((x-y)**2, axis=2)), axis=1)
+    asymmetry_scores[:, -1] = np.mean(asymmetry_scores[:, 0:-1], axis=1)
     
     column_names = list(feature_idx.keys())+['overall']
-    asymmetry_scores = pd.DataFrame(data=asymmetry_scores, columns=column_names)
+    index = frames if frames is not None else None
+    asymmetry_scores = pd.DataFrame(data=asymmetry_scores, columns=column_names, index=index)
              
     return asymmetry_scores
 
 
-# use_negatives: whether to use negative peaks, 0: only positive peaks, 1: only negative peaks, 2: both
-def expressivity(activations, axis=0, use_negatives=0, num_scales=6, robust=True, fps=30):
+def _activation_values(activations, axis=0):
     # make sure data is in the right format
     data = get_data_values(activations)
     
     # whether rows are time points (axis=0) or signals (axis=1)
     if axis == 1:
         data = data.T
+        
+    return np.asarray(data, dtype=float)
+
+
+def _check_peaks(data, peaks, num_scales, fps):
+    # peaks of all signals at multiple scales, shape (num_scales, num_frames, num_signals) as returned by
+    # peak_detection, detected if not given
+    if peaks is None:
+        return peak_detection(data, num_scales=num_scales, fps=fps, smooth=True, noise_removal=False)
     
+    peaks = np.asarray(peaks)
+    if peaks.ndim != 3 or peaks.shape[1:] != data.shape:
+        raise ValueError("Peaks must have shape (num_scales, %d, %d)." % data.shape)
+    
+    return peaks
+
+
+def _selected_peaks(data, peaks, use_negatives, robust):
+    # Peaks (see use_negatives) stored sparsely as the scale, frame, signal, sign, and value of each peak,
+    # sorted by scale, signal, and frame. If robust, we only consider inliers (removing outliers) of each signal
+    # and scale with more than 5 peaks.
+    if use_negatives == 0: # only use positives
+        selected = peaks == 1
+    elif use_negatives == 1: # only use negatives
+        selected = peaks == -1
+    else: # use both
+        selected = peaks != 0
+    
+    num_scales = peaks.shape[0]
     num_signals = data.shape[1]
     
-    expresivity_stats = []
-    # define dataframes for each scale
-    for s in range(num_scales):
-         # number of peaks, density (average across entire signal), mean (across peak activations), std, min, max
-        _data = pd.DataFrame(columns=['number', 'density', 'mean', 'std', 'min', 'max'])
-        expresivity_stats.append(_data)
+    scales, signals, frames = np.nonzero(selected.transpose((0, 2, 1)))
+    signs = peaks[scales, frames, signals]
+    values = data[frames, signals]
     
-    # for each signal
-    for i in range(num_signals):
-        signal = data[:,i]
+    if robust and len(values) > 0:
+        groups = scales * num_signals + signals
+        counts = np.bincount(groups, minlength=num_scales*num_signals)
         
-        # detect peaks at multiple scales
-        peaks = peak_detection(signal, num_scales=num_scales, fps=fps, smooth=True, noise_removal=False)
+        # values of each group in a row, padded with NaN
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        positions = np.arange(len(values)) - starts[groups]
+        packed = np.full((num_scales*num_signals, counts.max()), np.nan)
+        packed[groups, positions] = values
         
-        for s in range(num_scales):
-            _peaks = peaks[s, :]
-            
-            # whether we use negative peaks
-            if use_negatives == 0:
-                idx = np.where(_peaks==1)[0]
-            elif use_negatives == 1:
-                idx = np.where(_peaks==-1)[0]
-            elif use_negatives == 2:
-                idx = np.where(_peaks!=0)[0]
-            else:
-                raise ValueError("Invalid value for use_negatives")
-            
-            # extract the peaked signal
-            # if robust, we only consider inliers (removing outliers)
-            peaked_signal = signal[idx]
-            if robust and len(idx) > 5:
-                outliers = outlier_detectionIQR(peaked_signal)
-                peaked_signal = np.delete(peaked_signal, outliers)
-                
-            # calculate the statistics
-            if len(peaked_signal) == 0:
-                print("No peaks detected for signal %d at scale %d" % (i, s))
-                results = np.zeros(6)
-            else:
-                _number = len(peaked_signal)
-                _density = peaked_signal.sum() / len(signal)
-                _mean = peaked_signal.mean()
-                _std = peaked_signal.std()
-                _min = peaked_signal.min()
-                _max = peaked_signal.max()
-                results = [_number, _density, _mean, _std, _min, _max]
+        rows = counts > 5
+        Q1 = np.full(len(counts), -np.inf)
+        Q3 = np.full(len(counts), np.inf)
+        if np.any(rows):
+            Q1[rows], Q3[rows] = np.nanpercentile(packed[rows], [25, 75], axis=1)
+        IQR = Q3 - Q1
+        inliers = ~((values < Q1[groups] - 1.5 * IQR[groups]) | (values > Q3[groups] + 1.5 * IQR[groups]))
+        inliers |= ~rows[groups]
         
-            expresivity_stats[s].loc[i] = results
+        scales, frames, signals, signs, values = scales[inliers], frames[inliers], signals[inliers], signs[inliers], values[inliers]
         
-    return expresivity_stats
+    return scales, frames, signals, signs, values
 
 
-def diversity(activations, axis=0, use_negatives=0, num_scales=6, robust=True, fps=30):
-    # make sure data is in the right format
-    data = get_data_values(activations)
+def _expressivity_stats(selected, num_scales, num_frames, num_signals):
+    scales, frames, signals, signs, values = selected
     
-    # whether rows are time points (axis=0) or signals (axis=1)
-    if axis == 1:
-        data = data.T
-        
-    num_frames, num_signals = data.shape
+    # statistics of the peaks of each scale and signal, all zeros for the signals without peaks
+    # number of peaks, density (average across entire signal), mean (across peak activations), std, min, max
+    size = num_scales * num_signals
+    groups = scales * num_signals + signals
+    number = np.bincount(groups, minlength=size)
+    found = number > 0
     
-    #STEP 1: Detect peaks at multiple scales
-    #---------------------------------------
+    total = np.bincount(groups, weights=values, minlength=size)
+    mean = np.divide(total, number, out=np.zeros(size), where=found)
+    variance = np.bincount(groups, weights=(values - mean[groups])**2, minlength=size)
+    std = np.sqrt(np.divide(variance, number, out=np.zeros(size), where=found))
+    
+    # values of each group are consecutive
+    starts = np.concatenate(([0], np.cumsum(number)[:-1]))[found]
+    minimum = np.zeros(size)
+    maximum = np.zeros(size)
+    if len(values) > 0:
+        minimum[found] = np.minimum.reduceat(values, starts)
+        maximum[found] = np.maximum.reduceat(values, starts)
+    
+    results = np.stack((number, total / num_frames, mean, std, minimum, maximum), axis=1).reshape((num_scales, num_signals, 6))
+    
+    for s, i in zip(*np.nonzero(~found.reshape((num_scales, num_signals)))):
+        logger.info("No peaks detected for signal %d at scale %d" % (i, s))
+    
+    return [pd.DataFrame(results[s], columns=['number', 'density', 'mean', 'std', 'min', 'max']) for s in range(num_scales)]
 
-    # peak data will have shape (num_scales, num_frames, num_signals)
-    # we will compute diversity for pos and neg separately and take the average
-    data_peaked_pos = [0] * num_scales
-    data_peaked_neg = [0] * num_scales
-    for s in range(num_scales):
-        data_peaked_pos[s] = np.zeros((num_frames, num_signals))
-        data_peaked_neg[s] = np.zeros((num_frames, num_signals))
 
-    for i in range(num_signals):
-        signal = data[:, i]
+def _diversity_scores(selected, use_negatives, num_scales, num_frames, num_signals):
+    scales, frames, signals, signs, values = selected
+    
+    if use_negatives == 0: # only use positives
+        data_final = [1]
+    elif use_negatives == 1: # only use negatives
+        data_final = [-1]
+    else: # use both
+        data_final = [1, -1]
+    
+    #TODO: make sure each signal has the same range. Otherwise, we need to normalize the probabilities
+    base = num_signals#2
+    
+    # compute entropy for pos and neg separately and take the average
+    entropy = np.zeros(num_scales)
+    entropy_frame = np.zeros(num_scales)
+    for sign in data_final:
+        idx = signs == sign
+        _scales, _frames, _signals = scales[idx], frames[idx], signals[idx]
+        magnitudes = np.abs(values[idx])
         
-        # detect peaks at multiple scales
-        peaks = peak_detection(signal, num_scales=num_scales, fps=fps, smooth=True, noise_removal=False)
+        # type 1: compute for the entire time period
+        # (bincount returns integers if there are no peaks)
+        prob = np.bincount(_scales * num_signals + _signals, weights=magnitudes, minlength=num_scales*num_signals).astype(float).reshape((num_scales, num_signals))
+        normalizer = prob.sum(axis=1, keepdims=True)
+        prob = np.divide(prob, normalizer, out=prob, where=normalizer > 0)
         
-        for s in range(num_scales):
-            _peaks = peaks[s, :]
-            
-            # whether we use negative peaks or not
-            if use_negatives == 0: # only use positives
-                _peaks[_peaks==-1] = 0
-            elif use_negatives == 1: # only use negatives
-                _peaks[_peaks==1] = 0
-            
-            # if robust, we only consider inliers (removing outliers)
-            idx = np.where(_peaks!=0)[0]
-            if robust and len(idx) > 5:
-                outliers = outlier_detectionIQR(signal[idx])
-                idx = np.delete(idx, outliers)
-            tmp = _peaks[idx]
-            _peaks[:] = 0
-            _peaks[idx] = tmp
-            
-            # store the peaked signal
-            signal_pos = np.zeros_like(signal)
-            signal_pos[_peaks==1] = signal[_peaks==1]
-            signal_neg = np.zeros_like(signal)
-            signal_neg[_peaks==-1] = signal[_peaks==-1]
-            
-            data_peaked_pos[s][:, i] = signal_pos
-            data_peaked_neg[s][:, i] = signal_neg
-            
-    #STEP 2: Compute diversity at each scale
-    #---------------------------------------
-    diversity = pd.DataFrame(index=range(num_scales), columns=['overall', 'frame_wise'])
-    for s in range(num_scales):
+        entropy += -1 * np.sum(prob * log_transform(prob, base), axis=1)
         
-        data_final = []
-        if use_negatives == 0: # only use positives
-            data_final = [data_peaked_pos[s]]
-        elif use_negatives == 1: # only use negatives
-            data_final = [data_peaked_neg[s]]
-        elif use_negatives == 2: # use both
-            data_final = [data_peaked_pos[s], data_peaked_neg[s]]
-        else:
-            raise ValueError("Invalid value for use_negatives")
+        # type 2: compute for each frame separately and take the average (frames without peaks have zero entropy)
+        rows = _scales * num_frames + _frames
+        normalizer = np.bincount(rows, weights=magnitudes, minlength=num_scales*num_frames)
+        prob_frame = np.zeros(len(magnitudes))
+        np.divide(magnitudes, normalizer[rows], out=prob_frame, where=normalizer[rows] > 0)
         
-        # compute entropy for pos and neg separately and take the average
-        entropy = 0
-        entropy_frame = 0
-        for data_peaked in data_final:            
-            #TODO: make sure each signal has the same range. Otherwise, we need to normalize the probabilities
-            
-            base = num_signals#2
-            
-            # type 1: compute for the entire time period
-            prob = np.abs(data_peaked).sum(axis=0)
-            normalizer = prob.sum()
-            if normalizer > 0:
-                prob /= normalizer
-            
-            log_prob = log_transform(prob, base)
-            
-            # type 2: compute for each frame separately and take the average
-            prob_frame = np.zeros_like(data_peaked)
-            for f in range(num_frames):
-                normalizer = np.abs(data_peaked[f, :]).sum()
-                if normalizer > 0:
-                    prob_frame[f, :] = np.abs(data_peaked[f, :]) / normalizer
-            prob_frame[np.isinf(prob_frame)] = 0
-            prob_frame[np.isnan(prob_frame)] = 0
-            
-            log_prob_frame = log_transform(prob_frame, base)
-            
-            entropy += -1 * np.sum(prob * log_prob)
-            entropy_frame += -1 * np.sum(prob_frame * log_prob_frame, axis=1)
-            
-        entropy /= len(data_final)
-        entropy_frame /= len(data_final)
+        entropy_frame += -1 * np.bincount(_scales, weights=prob_frame * log_transform(prob_frame, base), minlength=num_scales) / num_frames
         
-        diversity.loc[s, :] = [entropy, entropy_frame.mean()]
+    entropy /= len(data_final)
+    entropy_frame /= len(data_final)
+    
+    diversity = pd.DataFrame({'overall': entropy, 'frame_wise': entropy_frame}, index=range(num_scales))
     
     return diversity
+
+
+# use_negatives: whether to use negative peaks, 0: only positive peaks, 1: only negative peaks, 2: both
+# peaks: output of peak_detection (smooth=True, noise_removal=False) for the same data, detected if None.
+#        If given, its scales are used instead of num_scales and fps.
+@profiled
+def expressivity(activations, axis=0, use_negatives=0, num_scales=6, robust=True, fps=30, peaks=None):
+    data = _activation_values(activations, axis=axis)
+    num_frames, num_signals = data.shape
+    
+    if use_negatives not in (0, 1, 2):
+        raise ValueError("Invalid value for use_negatives")
+    
+    peaks = _check_peaks(data, peaks, num_scales, fps)
+    selected = _selected_peaks(data, peaks, use_negatives, robust)
+        
+    return _expressivity_stats(selected, peaks.shape[0], num_frames, num_signals)
+
+
+# see expressivity for the parameters
+@profiled
+def diversity(activations, axis=0, use_negatives=0, num_scales=6, robust=True, fps=30, peaks=None):
+    data = _activation_values(activations, axis=axis)
+    num_frames, num_signals = data.shape
+    
+    if use_negatives not in (0, 1, 2):
+        raise ValueError("Invalid value for use_negatives")
+    
+    #STEP 1: Detect peaks at multiple scales
+    #---------------------------------------
+    peaks = _check_peaks(data, peaks, num_scales, fps)
+    selected = _selected_peaks(data, peaks, use_negatives, robust)
             
+    #STEP 2: Compute diversity at each scale
+    #---------------------------------------
+    return _diversity_scores(selected, use_negatives, peaks.shape[0], num_frames, num_signals)
+
+
+# Expressivity and diversity of the activations (and asymmetry of the landmarks, if given) with a single
+# peak detection and outlier removal shared by all. Returns a dictionary with 'expressivity', 'diversity', and
+# 'asymmetry' (if landmarks are given) as returned by the individual functions. See expressivity for the parameters,
+# axis is used for both activations and landmarks.
+@profiled
+def compute_all(activations, landmarks=None, axis=0, use_negatives=0, num_scales=6, robust=True, fps=30, peaks=None):
+    data = _activation_values(activations, axis=axis)
+    num_frames, num_signals = data.shape
+    
+    if use_negatives not in (0, 1, 2):
+        raise ValueError("Invalid value for use_negatives")
+    
+    peaks = _check_peaks(data, peaks, num_scales, fps)
+    selected = _selected_peaks(data, peaks, use_negatives, robust)
+    
+    results = {
+        'expressivity': _expressivity_stats(selected, peaks.shape[0], num_frames, num_signals),
+        'diversity': _diversity_scores(selected, use_negatives, peaks.shape[0], num_frames, num_signals)
+    }
+    
+    if landmarks is not None:
+        results['asymmetry'] = asymmetry(landmarks, axis=axis)
+        
+    return results
@@ -1,2 +1,4 @@
 from .backend3DI import FaceProcessor3DI
-from .backend3DI import FaceProcessor3DITest
\ No newline at end of file
+from .backend3DI import FaceProcessor3DITest
+from .scheduler import Stage, StageScheduler
+from .instrumentation import MemorySink, JSONLinesSink, LoggingSink, read_records
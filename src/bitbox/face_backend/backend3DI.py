@@ -1,30 +1,71 @@
 import os
+import sys
+import copy
+import asyncio
 import warnings
+import functools
+import multiprocessing.util
 
 import numpy as np
 
-from time import time
+from time import time, thread_time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from ..utilities import FileCache
 
+from .scheduler import Stage, StageScheduler, stage_dependencies
+from .runner import run_command, arun_command, CommandError, PersistentContainer, container_name, remove_container
+from .instrumentation import MemorySink, stage_report
+
 from .reader3DI import read_rectangles, read_landmarks
 from .reader3DI import read_pose, read_expression, read_canonical_landmarks
+from .reader3DI import save_binary
+
+# outputs that are kept when the cache exceeds its size budget
+PINNED_OUTPUTS = ['_expression_localized', '_landmarks_canonicalized']
 
 class FaceProcessor3DI:
-    def __init__(self, camera_model=30, landmark_model='global4', morphable_model='BFMmm-19830', basis_model='0.0.1.F591-cd-K32d', fast=False, return_output=True):
+    def __init__(self, camera_model=30, landmark_model='global4', morphable_model='BFMmm-19830', basis_model='0.0.1.F591-cd-K32d', fast=False, return_output=True, timeout=None, persistent_container=False, cache_index=None, cache_budget=None, sinks=None):
+        # keep the configuration so that identical processors can be created for batch workers
+        self._config = {
+            'camera_model': camera_model,
+            'landmark_model': landmark_model,
+            'morphable_model': morphable_model,
+            'basis_model': basis_model,
+            'fast': fast,
+            'return_output': return_output,
+            'timeout': timeout,
+            'persistent_container': persistent_container,
+            'cache_index': cache_index,
+            'cache_budget': cache_budget
+        }
+        
         self.file_input = None
         self.dir_output = None
         self.execDIR = None
         self.use_docker = False
+        self.container = None
         self.base_metadata = None
+        # outputs evicted from the cache that are not needed by the current run (see _skip_evicted)
+        self._evicted = set()
         
         self.model_camera = camera_model
         self.model_morphable = morphable_model
         self.model_landmark = landmark_model
         self.model_basis = basis_model
         self.fast = fast
+        # maximum duration of each step in seconds (None: no limit)
+        self.timeout = timeout
+        
+        # metadata of the outputs is kept in a SQLite database if cache_index (path) is given, otherwise in JSON files
+        # cache_budget (e.g., '100 GB') limits the size of the outputs kept in an output directory, see FileCache.gc
+        # final outputs are never evicted
+        self.cache = FileCache(index=cache_index, size_budget=cache_budget, pinned=PINNED_OUTPUTS)
         
-        self.cache = FileCache()
+        # timing and resource usage of each processing step are recorded in stage_records and passed to
+        # sinks (see instrumentation), e.g., sinks=[JSONLinesSink('stages.jsonl')]
+        self.stage_records = MemorySink()
+        self.sinks = _sink_list(sinks)
         
         self.return_output = return_output
         
@@ -34,6 +75,9 @@ class FaceProcessor3DI:
             self.use_docker = True
             self.execDIR = '/app/build'
             self.docker = os.environ.get('DOCKER_3DI')
+            # run all steps inside one long-lived container instead of a new container per step
+            if persistent_container:
+                self.container = PersistentContainer(self.docker, workdir=self.execDIR)
         else:
             if os.environ.get('PATH_3DI'):
                 execDIRs = [os.environ.get('PATH_3DI')]
@@ -53,6 +97,9 @@ class FaceProcessor3DI:
         if self.execDIR is None:
             raise ValueError("3DI package is not found. Please make sure you defined PATH_3DI system variable.")
         
+        if persistent_container and not self.use_docker:
+            warnings.warn("persistent_container is only used with Docker (DOCKER_3DI). Ignoring it.")
+        
         if not self.use_docker:
             # set the working directory
             # @TODO: remove this line when the 3DI code is updated by Vangelis
@@ -67,100 +114,232 @@ class FaceProcessor3DI:
         self.config_landmarks = os.path.join(self.execDIR, 'configs/%s.cfg%d.%s.txt' % (self.model_morphable, cfgid, self.model_landmark)) 
                 
     
+    def _command(self, executable, parameters, name=None):
+        # command line arguments of an executable
+        # name: name of the container started with docker run or of the process run in the persistent container, if any
+        if self.container is not None: # check if we are using a persistent docker container
+            self.container.ensure([os.path.dirname(self.file_input), self.dir_output])
+            args = self.container.exec_args(executable, name=name)
+        elif self.use_docker: # check if we are using a docker container
+            input_dir = os.path.dirname(self.file_input)
+            args = ['docker', 'run', '--rm', '--name', name, '--gpus', 'all', '-v', f"{input_dir}:{input_dir}", '-v', f"{self.dir_output}:{self.dir_output}", '-w', '/app/build', self.docker, f"./{executable}"]
+        else:
+            args = [os.path.join(self.execDIR, executable)]
+        
+        # parameters
+        for p in parameters:
+            if p is None:
+                raise ValueError("File names are not set correctly. Please use io() method prior to running any processing.")
+            args.append(str(p))
+            
+        return args
+    
+    
+    def _log_file(self, executable):
+        # standard error of each step is stored in the logs directory within the output directory
+        name = os.path.splitext(os.path.basename(executable))[0]
+        
+        return os.path.join(self.dir_output, 'logs', '%s_%s.log' % (self.file_input_base, name))
+        
+    
+    def _container_name(self):
+        # name of the container of a step started with docker run, or of its process in the persistent container
+        if self.use_docker:
+            return container_name()
+        
+        return None
+    
+    
+    def _abort_container(self, error, name=None):
+        # killing `docker exec` or `docker run` does not stop the command inside the container. Unless the
+        # command exited on its own, we remove the container of the step, or kill the step's process in the
+        # persistent container, which is shared with the steps of other videos (run_pipeline, arun_all).
+        if name is None or (isinstance(error, CommandError) and not error.timed_out):
+            return
+        
+        if self.container is not None:
+            self.container.kill(name)
+        else:
+            remove_container(name)
+                
+                
+    def close(self):
+        # stop the persistent docker container, if any
+        if self.container is not None:
+            self.container.stop()
+            
+            
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        
+    
     def _run_command(self, executable, parameters, output_file_idx, system_call):                  
         if system_call: # if we are using system call          
-            # executable
-            if self.use_docker: # check if we are using a docker container
-                input_dir = os.path.dirname(self.file_input)
-                cmd = f"docker run --rm --gpus all -v {input_dir}:{input_dir} -v {self.dir_output}:{self.dir_output} -w /app/build {self.docker} ./{executable}"
-            else:
-                cmd = os.path.join(self.execDIR, executable)
-            
-            # parameters
-            for p in parameters:
-                if p is None:
-                    raise ValueError("File names are not set correctly. Please use io() method prior to running any processing.")
-                cmd += ' ' + str(p)
-            # suppress the output of the command. check whether we are on a Windows or Unix-like system
-            if os.name == 'nt': # Windows
-                cmd += ' > NUL'
-            else: # Unix-like systems (Linux, macOS)
-                cmd += ' > /dev/null'          
-            os.system(cmd)
+            name = self._container_name()
+            args = self._command(executable, parameters, name=name)
+            cwd = None if self.use_docker else self.execDIR
+            try:
+                usage = run_command(args, log_file=self._log_file(executable), timeout=self.timeout, cwd=cwd)
+            except BaseException as e:
+                self._abort_container(e, name)
+                raise
+            cmd = ' '.join(args)
         else: # if we are using a python function
             cmd = "%s()" % executable
             # prepare the function
             func = getattr(self, executable)
-            func(*parameters)
+            usage = {'cpu_time': _thread_cpu_time(func, *parameters), 'max_rss': None}
             
-        return cmd
+        return cmd, usage
     
     
-    def _execute(self, executable, parameters, name, output_file_idx=-1, system_call=True):
-        status = False
-        
-        # get the output file name
-        if not isinstance(output_file_idx, list):
-            output_file_idx = [output_file_idx]
-       
-        # check if the output file already exists, if not run the executable
-        self.base_metadata = {
+    async def _arun_command(self, executable, parameters, output_file_idx, system_call):
+        if system_call:
+            name = self._container_name()
+            args = self._command(executable, parameters, name=name)
+            cwd = None if self.use_docker else self.execDIR
+            try:
+                await arun_command(args, log_file=self._log_file(executable), timeout=self.timeout, cwd=cwd)
+            except BaseException as e:
+                self._abort_container(e, name)
+                raise
+            cmd = ' '.join(args)
+            # the event loop reaps the command, so its resource usage is not available
+            usage = None
+        else: # python functions are run in a thread not to block the event loop
+            cmd = "%s()" % executable
+            func = getattr(self, executable)
+            cpu_time = await asyncio.get_running_loop().run_in_executor(None, functools.partial(_thread_cpu_time, func, *parameters))
+            usage = {'cpu_time': cpu_time, 'max_rss': None}
+            
+        return cmd, usage
+    
+    
+    def _metadata(self):
+        metadata = {
             'backend' : '3DI',
             'morphable_model': self.model_morphable,
             'camera': self.model_camera,
             'landmark': self.model_landmark,
             'fast': self.fast
-        }  
+        }
+        
+        return metadata
+    
+    
+    def _prepare_outputs(self, parameters, output_file_idx, inputs=None):
+        # returns True if the outputs need to be (re)generated
+        # inputs: files the outputs are generated from, outputs are regenerated if their content changes
+        
+        # check if the output file already exists, if not run the executable
+        self.base_metadata = self._metadata()
+        
+        # outputs were evicted from the cache and no other step needs them
+        if all([parameters[idx] in self._evicted for idx in output_file_idx]):
+            return False
         
         file_exits = 0
         for idx in output_file_idx:
-            tmp = self.cache.check_file(parameters[idx], self.base_metadata, verbose=True)
+            tmp = self.cache.check_file(parameters[idx], self.base_metadata, verbose=True, inputs=inputs)
             file_exits = max(file_exits, tmp)
+            
+        # outputs are reused, mark them as recently used (only needed to evict the least recently used files)
+        if file_exits == 0 and self.cache.size_budget is not None:
+            for idx in output_file_idx:
+                self.cache.touch(parameters[idx])
         
-        # run the executable if needed
-        if file_exits > 0: # file does not exist, has different metadata, or it is older than the retention period
-            # if needed, change the name of the output file
-            # @TODO: when we change the file name, next time we run the code, we should be using the latest file generated, which is hard to track. We are rewriting for now.
-            # @TODO: for the same reason above, we need to remove the old metadata file otherwise "file_generated" will be >0 and fail the check
-            # @TODO: also we need to consider multiple output files
-            if file_exits == 2:
-                # delete this loop after resolving above @TODO
-                for idx in output_file_idx:
-                    self.cache.delete_old_file(parameters[idx])
-                #output_file = self.cache.get_new_file_name(output_file)  # uncomment after resolving above @TODO
-                #parameters[output_file_idx] = output_file  # uncomment after resolving above @TODO
+        # if needed, change the name of the output file
+        # @TODO: when we change the file name, next time we run the code, we should be using the latest file generated, which is hard to track. We are rewriting for now.
+        # @TODO: for the same reason above, we need to remove the old metadata file otherwise "file_generated" will be >0 and fail the check
+        # @TODO: also we need to consider multiple output files
+        if file_exits >= 2:
+            # delete this loop after resolving above @TODO
+            for idx in output_file_idx:
+                self.cache.delete_old_file(parameters[idx])
+            #output_file = self.cache.get_new_file_name(output_file)  # uncomment after resolving above @TODO
+            #parameters[output_file_idx] = output_file  # uncomment after resolving above @TODO
+                
+        # file does not exist, has different metadata, or it is older than the retention period
+        return file_exits > 0
+    
+    
+    def _finalize_outputs(self, cmd, parameters, output_file_idx, name, inputs=None):
+        # check if the command was successful
+        file_generated = 0
+        for idx in output_file_idx:
+            tmp = self.cache.check_file(parameters[idx], self.base_metadata, verbose=False, json_required=False, retention_period='5 minutes')
+            file_generated = max(file_generated, tmp)
+        
+        if file_generated > 0: # file is not generated (0 means the file is found)
+            raise ValueError("Failed running %s" % name)
+        
+        # store metadata
+        additional_metadata = {
+            'cmd': cmd,
+            'input': self.file_input,
+            'output': self.dir_output
+        }
+        metadata = {**self.base_metadata, **additional_metadata}
+        for idx in output_file_idx:
+            self.cache.store_metadata(parameters[idx], metadata, inputs=inputs)
             
-            # run the command
-            print("Running %s..." % name, end='', flush=True)
+        # create binary copies of the outputs that are read by the read_* functions so that they are fast to load
+        readable_outputs = self._readable_outputs()
+        for idx in output_file_idx:
+            if parameters[idx] in readable_outputs:
+                try:
+                    saved = save_binary(parameters[idx])
+                except ValueError: # the output could not be parsed
+                    saved = False
+                if not saved: # or written, e.g., read-only directory or disk full
+                    warnings.warn("Binary copy of %s could not be created." % parameters[idx])
+    
+    
+    def _execute(self, executable, parameters, name, output_file_idx=-1, system_call=True, inputs=None):
+        # returns whether the outputs were (re)generated and the resource usage of the command
+        # get the output file name
+        if not isinstance(output_file_idx, list):
+            output_file_idx = [output_file_idx]
+       
+        # run the executable if needed
+        if self._prepare_outputs(parameters, output_file_idx, inputs=inputs):
+            # steps of other videos may be running in other threads (run_pipeline), so we print a single line at the end
             t0 = time()
-            cmd = self._run_command(executable, parameters, output_file_idx, system_call)
-            print(" (Took %.2f secs)" % (time()-t0))
+            try:
+                cmd, usage = self._run_command(executable, parameters, output_file_idx, system_call)
+            finally:
+                _print_line("Running %s for %s... (Took %.2f secs)" % (name, self.file_input_base, time()-t0))
             
-            # check if face detection was successful
-            file_generated = 0
-            for idx in output_file_idx:
-                tmp = self.cache.check_file(parameters[idx], self.base_metadata, verbose=False, json_required=False, retention_period='5 minutes')
-                file_generated = max(file_generated, tmp)
+            self._finalize_outputs(cmd, parameters, output_file_idx, name, inputs=inputs)
             
-            if file_generated == 0: # file is generated (0 means the file is found)
-                # store metadata
-                additional_metadata = {
-                    'cmd': cmd,
-                    'input': self.file_input,
-                    'output': self.dir_output
-                }
-                metadata = {**self.base_metadata, **additional_metadata}
-                for idx in output_file_idx:
-                    self.cache.store_metadata(parameters[idx], metadata)
-                    
-                status = True
-            else:
-                status = False
-        else: # file is already present
-            status = True
+            return True, usage
+        
+        return False, None
             
-        if not status:
-            raise ValueError("Failed running %s" % name)
+            
+    async def _aexecute(self, executable, parameters, name, output_file_idx=-1, system_call=True, inputs=None):
+        if not isinstance(output_file_idx, list):
+            output_file_idx = [output_file_idx]
+        
+        # checking the cache (hashing the inputs) and creating the binary copies of the outputs read entire
+        # files, they are run in a thread not to block the event loop
+        loop = asyncio.get_running_loop()
+        
+        if await loop.run_in_executor(None, functools.partial(self._prepare_outputs, parameters, output_file_idx, inputs=inputs)):
+            # other jobs may be printing at the same time, so we print a single line at the end
+            t0 = time()
+            cmd, usage = await self._arun_command(executable, parameters, output_file_idx, system_call)
+            _print_line("Running %s for %s... (Took %.2f secs)" % (name, self.file_input_base, time()-t0))
+            
+            await loop.run_in_executor(None, functools.partial(self._finalize_outputs, cmd, parameters, output_file_idx, name, inputs=inputs))
+            
+            return True, usage
+        
+        return False, None
     
         
     def io(self, input_file, output_dir):
@@ -183,6 +362,12 @@ class FaceProcessor3DI:
             raise ValueError("Cannot create output directory. Please check the path and permissions.")  
  
         # if no exception is raised, set the input file and output directory
+        self._set_files(input_file, output_dir)
+        
+        
+    def _set_files(self, input_file, output_dir):
+        ext = input_file.split('.')[-1].lower()
+        
         self.file_input = input_file
         self.file_input_base = '.'.join(os.path.basename(input_file).split('.')[:-1])
         self.dir_output = output_dir
@@ -204,25 +389,173 @@ class FaceProcessor3DI:
         self.file_expression_localized = os.path.join(self.dir_output, self.file_input_base + '_expression_localized.3DI') # localized expressions
                
         
+    def stages(self, undistort=False, normalize=True):
+        # processing steps of the current video as a dependency graph (see scheduler.Stage)
+        # 3DI binaries use the GPU, python scripts only use the CPU
+        if self.file_input is None:
+            raise ValueError("File names are not set correctly. Please use io() method prior to running any processing.")
+        
+        stages = []
+        
+        video = self.file_input
+        if undistort:
+            # @TODO: check if self.model_camera is a valid file and includes undistortion parameters
+            stages.append(Stage('preprocess', 'video_undistort',
+                                [video, self.model_camera, self.file_input_prep],
+                                "video undistortion",
+                                output_file_idx=-1, inputs=[video]))
+            video = self.file_input_prep
+        
+        stages.append(Stage('detect_faces', 'video_detect_face',
+                            [video, self.file_rectangles],
+                            "face detection",
+                            output_file_idx=-1, inputs=[video]))
+        
+        stages.append(Stage('detect_landmarks', 'video_detect_landmarks',
+                            [video, self.file_rectangles, self.file_landmarks, self.config_landmarks],
+                            "landmark detection",
+                            output_file_idx=-2, inputs=[video, self.file_rectangles]))
+        
+        # STEP 1: learn identity
+        stages.append(Stage('learn_identity', 'video_learn_identity',
+                            [video, self.file_landmarks, self.config_landmarks, self.model_camera, self.file_shape_coeff, self.file_texture_coeff],
+                            "3D face model fitting",
+                            output_file_idx=[-2, -1], inputs=[video, self.file_landmarks]))
+        
+        # STEP 2: shape and texture model
+        stages.append(Stage('save_identity', 'scripts/save_identity_and_shape.py',
+                            [self.file_shape_coeff, self.file_texture_coeff, '1', '0.4', self.file_shape, self.file_texture, self.model_morphable],
+                            "shape and texture model",
+                            output_file_idx=[-3, -2], inputs=[self.file_shape_coeff, self.file_texture_coeff], resource='cpu'))
+        
+        # STEP 3: Pose and expression
+        stages.append(Stage('expression_pose', 'video_from_saved_identity',
+                            [video, self.file_landmarks, self.config_landmarks, self.model_camera, self.file_shape, self.file_texture, self.file_expression, self.file_pose, self.file_illumination],
+                            "expression and pose estimation",
+                            output_file_idx=[-3, -2, -1], inputs=[video, self.file_landmarks, self.file_shape, self.file_texture]))
+        
+        # STEP 4: Smooth expression and pose
+        stages.append(Stage('smooth_expression', 'scripts/total_variance_rec.py',
+                            [self.file_expression, self.file_expression_smooth, self.model_morphable],
+                            "expression smoothing",
+                            output_file_idx=-2, inputs=[self.file_expression], resource='cpu'))
+        
+        stages.append(Stage('smooth_pose', 'scripts/total_variance_rec_pose.py',
+                            [self.file_pose, self.file_pose_smooth],
+                            "pose smoothing",
+                            output_file_idx=-1, inputs=[self.file_pose], resource='cpu'))
+        
+        # STEP 5: Canonicalized landmarks
+        stages.append(Stage('canonicalize_landmarks', 'scripts/produce_canonicalized_3Dlandmarks.py',
+                            [self.file_expression_smooth, self.file_landmarks_canonicalized, self.model_morphable],
+                            "canonicalized landmark estimation",
+                            output_file_idx=-2, inputs=[self.file_expression_smooth], resource='cpu'))
+        
+        stages.append(Stage('localized_expressions', 'scripts/compute_local_exp_coefficients.py',
+                            [self.file_expression_smooth, self.file_expression_localized, self.model_morphable, self.model_basis, int(normalize)],
+                            "localized expression estimation",
+                            output_file_idx=-4, inputs=[self.file_expression_smooth], resource='cpu'))
+        
+        return stages
+    
+    
+    def _readable_outputs(self):
+        # outputs that are read by the read_* functions
+        return [self.file_rectangles, self.file_landmarks, self.file_expression_smooth, self.file_pose_smooth,
+                self.file_landmarks_canonicalized, self.file_expression_localized]
+    
+    
+    def _stage_status(self, stages):
+        # cache status (see FileCache.check_file) of the outputs of the stages
+        outputs = [f for stage in stages for f in stage.outputs]
+        inputs = [stage.inputs for stage in stages for _ in stage.outputs]
+        
+        return dict(zip(outputs, self.cache.check_files(outputs, self._metadata(), inputs=inputs)))
+    
+    
+    def _skip_evicted(self, stages):
+        # outputs evicted from the cache are only regenerated if a step that needs to run depends on them,
+        # or if they are returned
+        required = self._readable_outputs() if self.return_output else []
+        _, self._evicted = _evicted_outputs(stages, self._stage_status(stages), required)
+        
+        
+    def _missing(self, file_path):
+        # whether the output of a previous step is missing or out of date
+        return file_path not in self._evicted and self.cache.check_file(file_path, self.base_metadata) > 0
+    
+    
+    def _stage(self, name, undistort=False, normalize=True):
+        for stage in self.stages(undistort=undistort, normalize=normalize):
+            if stage.name == name:
+                return stage
+            
+        raise ValueError("Unknown processing stage %s" % name)
+    
+    
+    def _record_stage(self, stage, t0, status, generated, usage):
+        # see instrumentation for the fields of a record
+        record = {
+            'input': self.file_input,
+            'stage': stage.name,
+            'status': status,
+            'cache': None if generated is None else ('miss' if generated else 'hit'),
+            'start': t0,
+            'wall_time': time() - t0,
+            'cpu_time': None if usage is None else usage['cpu_time'],
+            'max_rss': None if usage is None else usage['max_rss'],
+            'input_bytes': _total_size(stage.inputs),
+            'output_bytes': _total_size(stage.outputs)
+        }
+        self._emit_records([record])
+        
+        
+    def _emit_records(self, records):
+        for record in records:
+            self.stage_records.emit(record)
+            for sink in self.sinks:
+                sink.emit(record)
+                
+                
+    def _execute_stage(self, stage):
+        t0 = time()
+        status, result = 'failed', (None, None)
+        try:
+            result = self._execute(stage.executable, stage.parameters, stage.description, output_file_idx=stage.output_file_idx, system_call=stage.system_call, inputs=stage.inputs)
+            status = 'done'
+        finally:
+            self._record_stage(stage, t0, status, *result)
+        
+        
+    async def _aexecute_stage(self, stage):
+        t0 = time()
+        status, result = 'failed', (None, None)
+        try:
+            result = await self._aexecute(stage.executable, stage.parameters, stage.description, output_file_idx=stage.output_file_idx, system_call=stage.system_call, inputs=stage.inputs)
+            status = 'done'
+        finally:
+            self._record_stage(stage, t0, status, *result)
+            
+            
+    def profile_report(self, records=None):
+        # where the time went per stage over all the steps run by this processor (including run_batch and
+        # run_pipeline), or over the given records (e.g., instrumentation.read_records of a JSONLinesSink file)
+        if records is None:
+            records = self.stage_records.records
+        
+        return stage_report(records)
+    
+    
     def preprocess(self, undistort=False):
         # run undistortion if needed
         if undistort==True:
-            # check if proper camera parameters are provided
-            # @TODO: check if self.model_camera is a valid file and includes undistortion parameters
-            
-            self._execute('video_undistort',
-                                   [self.file_input, self.model_camera, self.file_input_prep],
-                                   "video undistortion",
-                                   output_file_idx=-1)
+            self._execute_stage(self._stage('preprocess', undistort=True))
         
             self.file_input = self.file_input_prep
             
             
     def detect_faces(self):
-        self._execute('video_detect_face',
-                      [self.file_input, self.file_rectangles],
-                      "face detection",
-                      output_file_idx=-1)
+        self._execute_stage(self._stage('detect_faces'))
                
         if self.return_output:
             return read_rectangles(self.file_rectangles)
@@ -232,13 +565,10 @@ class FaceProcessor3DI:
             
     def detect_landmarks(self):
         # check if face detection was run and successful
-        if self.cache.check_file(self.file_rectangles, self.base_metadata) > 0:
+        if self._missing(self.file_rectangles):
             raise ValueError("Face detection is not run or failed. Please run face detection first.")
         
-        self._execute('video_detect_landmarks',
-                      [self.file_input, self.file_rectangles, self.file_landmarks, self.config_landmarks],
-                      "landmark detection",
-                      output_file_idx=-2)
+        self._execute_stage(self._stage('detect_landmarks'))
         
         if self.return_output:
             return read_landmarks(self.file_landmarks)
@@ -248,43 +578,11 @@ class FaceProcessor3DI:
 
     def fit(self):
         # check if landmark detection was run and successful
-        if self.cache.check_file(self.file_landmarks, self.base_metadata) > 0:
+        if self._missing(self.file_landmarks):
             raise ValueError("Landmark detection is not run or failed. Please run landmark detection first.")
      
-        # STEP 1: learn identity   
-        self._execute('video_learn_identity',
-                      [self.file_input, self.file_landmarks, self.config_landmarks, self.model_camera, self.file_shape_coeff, self.file_texture_coeff],
-                      "3D face model fitting",
-                      output_file_idx=[-2, -1])
-     
-        # STEP 2: shape and texture model
-        self._execute('scripts/save_identity_and_shape.py',
-                      [self.file_shape_coeff, self.file_texture_coeff, '1', '0.4', self.file_shape, self.file_texture, self.model_morphable],
-                      "shape and texture model",
-                      output_file_idx=[-3, -2])
-
-        # STEP 3: Pose and expression
-        self._execute('video_from_saved_identity',
-                      [self.file_input, self.file_landmarks, self.config_landmarks, self.model_camera, self.file_shape, self.file_texture, self.file_expression, self.file_pose, self.file_illumination],
-                      "expression and pose estimation",
-                      output_file_idx=[-3, -2, -1])
-
-        # STEP 4: Smooth expression and pose
-        self._execute('scripts/total_variance_rec.py',
-                    [self.file_expression, self.file_expression_smooth, self.model_morphable],
-                    "expression smoothing",
-                    output_file_idx=-2)
-                
-        self._execute('scripts/total_variance_rec_pose.py',
-                    [self.file_pose, self.file_pose_smooth],
-                    "pose smoothing",
-                    output_file_idx=-1)
-            
-        # STEP 5: Canonicalized landmarks
-        self._execute('scripts/produce_canonicalized_3Dlandmarks.py',
-                    [self.file_expression_smooth, self.file_landmarks_canonicalized, self.model_morphable],
-                    "canonicalized landmark estimation",
-                    output_file_idx=-2)
+        for name in ['learn_identity', 'save_identity', 'expression_pose', 'smooth_expression', 'smooth_pose', 'canonicalize_landmarks']:
+            self._execute_stage(self._stage(name))
         
         if self.return_output:
             return read_expression(self.file_expression_smooth), read_pose(self.file_pose_smooth), read_canonical_landmarks(self.file_landmarks_canonicalized)
@@ -294,13 +592,10 @@ class FaceProcessor3DI:
 
     def localized_expressions(self, normalize=True):
         # check if canonical landmark detection was run and successful
-        if self.cache.check_file(self.file_expression_smooth, self.base_metadata) > 0:
+        if self._missing(self.file_expression_smooth):
             raise ValueError("Expression quantification is not run or failed. Please run fit() method first.")
         
-        self._execute('scripts/compute_local_exp_coefficients.py',
-                    [self.file_expression_smooth, self.file_expression_localized, self.model_morphable, self.model_basis, int(normalize)],
-                    "localized expression estimation",
-                    output_file_idx=-4)
+        self._execute_stage(self._stage('localized_expressions', normalize=normalize))
         
         if self.return_output:
             return read_expression(self.file_expression_localized)
@@ -309,31 +604,390 @@ class FaceProcessor3DI:
 
 
     def run_all(self, undistort=False, normalize=True):
-        self.preprocess(undistort)
-        rect = self.detect_faces()
-        land = self.detect_landmarks()
-        exp_glob, pose, land_can = self.fit()
-        exp_loc = self.localized_expressions(normalize=normalize)
+        self._skip_evicted(self.stages(undistort=undistort, normalize=normalize))
+        try:
+            self.preprocess(undistort)
+            rect = self.detect_faces()
+            land = self.detect_landmarks()
+            exp_glob, pose, land_can = self.fit()
+            exp_loc = self.localized_expressions(normalize=normalize)
+        finally:
+            self._evicted = set()
         
         if self.return_output:
             return rect, land, exp_glob, pose, land_can, exp_loc
         else:
             return None, None, None, None, None, None
+        
+        
+    async def arun_all(self, undistort=False, normalize=True):
+        # asyncio version of run_all. Independent steps (e.g., expression and pose smoothing) run
+        # concurrently and many processors can be driven from the same event loop.
+        stages = self.stages(undistort=undistort, normalize=normalize)
+        dependencies = stage_dependencies(stages)
+        # reading the metadata of all outputs may take a while, do not block the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self._skip_evicted, stages)
+        
+        tasks = {}
+        async def _run(stage):
+            await asyncio.gather(*[tasks[d] for d in dependencies[stage.name]])
+            await self._aexecute_stage(stage)
+        
+        # stages are listed in the order they need to run, so dependencies are always created first
+        for stage in stages:
+            tasks[stage.name] = asyncio.ensure_future(_run(stage))
+        
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            # stop the remaining steps and wait until their commands are killed
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        finally:
+            self._evicted = set()
+        
+        if undistort:
+            self.file_input = self.file_input_prep
+            
+        if self.return_output:
+            return (read_rectangles(self.file_rectangles),
+                    read_landmarks(self.file_landmarks),
+                    read_expression(self.file_expression_smooth),
+                    read_pose(self.file_pose_smooth),
+                    read_canonical_landmarks(self.file_landmarks_canonicalized),
+                    read_expression(self.file_expression_localized))
+        else:
+            return None, None, None, None, None, None
+        
+        
+    def _run_batch_item(self, input_file, output_dir, run_kwargs):
+        report = {
+            'input': input_file,
+            'output': output_dir,
+            'status': 'failed',
+            'error': None,
+            'time': 0.0,
+            'records': []
+        }
+        
+        t0 = time()
+        num_records = len(self.stage_records.records)
+        try:
+            self.io(input_file=input_file, output_dir=output_dir)
+            self.run_all(**run_kwargs)
+            report['status'] = 'done'
+        except Exception as e: # a bad video should not abort the entire batch
+            report['error'] = "%s: %s" % (type(e).__name__, e)
+        report['time'] = time() - t0
+        # stage records of the video, batch workers send them back with the report
+        report['records'] = self.stage_records.records[num_records:]
+        
+        return report
+    
+    
+    def _batch_jobs(self, inputs, output_root):
+        # each video gets its own output directory named after the video file
+        jobs = []
+        for input_file in inputs:
+            base = '.'.join(os.path.basename(input_file).split('.')[:-1])
+            jobs.append((input_file, os.path.join(output_root, base)))
+            
+        output_dirs = [job[1] for job in jobs]
+        if len(set(output_dirs)) != len(output_dirs):
+            raise ValueError("Input videos must have unique file names as their outputs are stored in %s/<file name>." % output_root)
+        
+        return jobs
+    
+    
+    def _batch_mounts(self, jobs, output_root):
+        # directories a persistent docker container needs to access during a batch
+        mounts = [os.path.dirname(os.path.abspath(input_file)) for input_file, _ in jobs]
+        mounts.append(os.path.abspath(output_root))
+        
+        return sorted(set(mounts))
+    
+    
+    def collect_garbage(self, output_root):
+        # evict least recently used outputs if the output directory exceeds the cache budget
+        if self.cache.size_budget is None:
+            return None
+        
+        return self.cache.gc(output_root)
+    
+    
+    def pending(self, inputs, output_root, undistort=False, normalize=True):
+        # Videos (from inputs) whose outputs in output_root are missing or out of date, i.e., the ones
+        # run_batch or run_pipeline would actually process. With a cache index, the metadata of all
+        # outputs is read with a single query instead of opening a JSON file per output.
+        # Outputs evicted from the cache (see collect_garbage) do not make a video pending unless they are needed.
+        jobs = self._batch_jobs(inputs, output_root)
+        
+        graphs = []
+        for input_file, output_dir in jobs:
+            processor = copy.copy(self)
+            processor._set_files(input_file, output_dir)
+            graphs.append(processor.stages(undistort=undistort, normalize=normalize))
+        
+        status = self._stage_status([stage for stages in graphs for stage in stages])
+        
+        outdated = []
+        for (input_file, _), stages in zip(jobs, graphs):
+            run, _ = _evicted_outputs(stages, status, [])
+            if len(run) > 0:
+                outdated.append(input_file)
+        
+        return outdated
+    
+    
+    def run_batch(self, inputs, output_root, workers=1, undistort=False, normalize=True):
+        jobs = self._batch_jobs(inputs, output_root)
+        
+        # workers do not need to read the outputs back
+        config = {**self._config, 'return_output': False}
+        run_kwargs = {'undistort': undistort, 'normalize': normalize}
+        
+        num_jobs = len(jobs)
+        reports = [None] * num_jobs
+        
+        def _progress(idx, count):
+            report = reports[idx]
+            self._emit_records(report.get('records', []))
+            name = os.path.basename(report['input'])
+            if report['status'] == 'done':
+                _print_line("[%d/%d] %s: done (Took %.2f secs)" % (count, num_jobs, name, report['time']))
+            else:
+                _print_line("[%d/%d] %s: failed (%s)" % (count, num_jobs, name, report['error']))
+        
+        mounts = self._batch_mounts(jobs, output_root)
+        
+        if workers <= 1:
+            with type(self)(**config) as processor:
+                if processor.container is not None:
+                    processor.container.mount(mounts)
+                for idx, (input_file, output_dir) in enumerate(jobs):
+                    reports[idx] = processor._run_batch_item(input_file, output_dir, run_kwargs)
+                    _progress(idx, idx+1)
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker, initargs=(type(self), config, mounts)) as pool:
+                futures = {pool.submit(_run_batch_worker, input_file, output_dir, run_kwargs): idx for idx, (input_file, output_dir) in enumerate(jobs)}
+                for count, future in enumerate(as_completed(futures)):
+                    idx = futures[future]
+                    try:
+                        reports[idx] = future.result()
+                    except Exception as e: # e.g., the worker process died
+                        input_file, output_dir = jobs[idx]
+                        reports[idx] = {'input': input_file, 'output': output_dir, 'status': 'failed', 'error': "%s: %s" % (type(e).__name__, e), 'time': 0.0}
+                    _progress(idx, count+1)
+                    
+        num_failed = sum([r['status'] != 'done' for r in reports])
+        print("Batch finished: %d succeeded, %d failed" % (num_jobs-num_failed, num_failed))
+        
+        self.collect_garbage(output_root)
+        
+        return reports
+    
+    
+    def run_pipeline(self, inputs, output_root, limits=None, undistort=False, normalize=True):
+        # Similar to run_batch, but instead of running videos one after another on each worker, the
+        # stages of all videos are scheduled on a shared pool. A stage starts as soon as the stages
+        # producing its inputs are finished and its resource ('gpu' or 'cpu') has a free slot.
+        # limits: maximum number of concurrently running stages per resource or per stage name,
+        #         defaults to {'gpu': 1, 'cpu': <number of cores>}
+        jobs = self._batch_jobs(inputs, output_root)
+        config = {**self._config, 'return_output': False}
+        
+        reports = []
+        graphs = []
+        graph_reports = []
+        for input_file, output_dir in jobs:
+            report = {
+                'input': input_file,
+                'output': output_dir,
+                'status': 'failed',
+                'error': None,
+                'time': 0.0,
+                'stages': {}
+            }
+            try:
+                processor = type(self)(**config)
+                # stages run in threads of this process, so they are recorded directly
+                processor.stage_records = self.stage_records
+                processor.sinks = self.sinks
+                processor.io(input_file=input_file, output_dir=output_dir)
+                stages = processor.stages(undistort=undistort, normalize=normalize)
+                processor._skip_evicted(stages)
+                graphs.append((processor, stages))
+                graph_reports.append(report)
+            except Exception as e:
+                report['error'] = "%s: %s" % (type(e).__name__, e)
+            reports.append(report)
+        
+        # all videos share one persistent docker container, if enabled
+        container = None
+        if self.container is not None:
+            container = PersistentContainer(self.docker, workdir=self.execDIR)
+            container.mount(self._batch_mounts(jobs, output_root))
+            for processor, _ in graphs:
+                processor.container = container
+        
+        # wall time of each video, from the start of its first stage to the end of its last stage
+        timing = [[None, None] for _ in graphs]
+        processors = [g[0] for g in graphs]
+        
+        def _execute(processor, stage):
+            j = processors.index(processor)
+            t0 = time()
+            if timing[j][0] is None:
+                timing[j][0] = t0
+            try:
+                processor._execute_stage(stage)
+            finally:
+                timing[j][1] = time()
+            
+        scheduler = StageScheduler(limits)
+        try:
+            status, errors = scheduler.run(graphs, _execute)
+        finally:
+            if container is not None:
+                container.stop()
+        
+        for j, report in enumerate(graph_reports):
+            report['stages'] = status[j]
+            report['error'] = errors[j]
+            if all([s == 'done' for s in status[j].values()]):
+                report['status'] = 'done'
+            if timing[j][0] is not None:
+                report['time'] = timing[j][1] - timing[j][0]
+        
+        num_jobs = len(reports)
+        for idx, report in enumerate(reports):
+            name = os.path.basename(report['input'])
+            if report['status'] == 'done':
+                _print_line("[%d/%d] %s: done (Took %.2f secs)" % (idx+1, num_jobs, name, report['time']))
+            else:
+                _print_line("[%d/%d] %s: failed (%s)" % (idx+1, num_jobs, name, report['error']))
+        
+        num_failed = sum([r['status'] != 'done' for r in reports])
+        print("Batch finished: %d succeeded, %d failed" % (num_jobs-num_failed, num_failed))
+        
+        self.collect_garbage(output_root)
+        
+        return reports
+    
+    
+def _evicted_outputs(stages, status, required):
+    # Outputs evicted from the cache (status 3, see FileCache.check_file) are not regenerated if the other
+    # outputs of their stage are up to date and no stage that needs to run depends on them, e.g., when the
+    # final outputs are up to date. required: outputs that are always regenerated (e.g., returned ones)
+    # returns the names of the stages that need to run and the outputs of the stages that are skipped
+    dependencies = stage_dependencies(stages)
+    
+    run = set()
+    skipped = set()
+    # stages are listed in the order they need to run, so the stages depending on a stage are visited first
+    for stage in reversed(stages):
+        codes = [status[f] for f in stage.outputs]
+        if max(codes) == 0:
+            continue
+        
+        evicted = all([c in (0, 3) for c in codes]) and not any([f in required for f in stage.outputs])
+        needed = any([s.name in run for s in stages if stage.name in dependencies[s.name]])
+        if evicted and not needed:
+            skipped.update(stage.outputs)
+        else:
+            run.add(stage.name)
+            
+    return run, skipped
+
+
+def _sink_list(sinks):
+    if sinks is None:
+        return []
+    if not isinstance(sinks, (list, tuple)):
+        return [sinks]
+    return list(sinks)
+
+
+def _total_size(files):
+    # total size of the existing files in bytes
+    size = 0
+    for f in files:
+        try:
+            size += os.path.getsize(f)
+        except (OSError, TypeError):
+            pass
+        
+    return size
+
+
+def _print_line(line):
+    # print() writes the text and the newline separately, so lines printed by concurrent threads or worker
+    # processes can be merged. The line is written at once instead.
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+
+def _thread_cpu_time(func, *args):
+    # cpu time of a python function run in the current thread
+    t0 = thread_time()
+    func(*args)
+    
+    return thread_time() - t0
+
+
+# each batch worker process creates one processor and reuses it for all the videos it receives
+_batch_processor = None
+
+def _init_batch_worker(cls, config, mounts):
+    global _batch_processor
+    _batch_processor = cls(**config)
+    
+    # the persistent docker container of the worker, if any, is started once and removed when the worker exits
+    if _batch_processor.container is not None:
+        _batch_processor.container.mount(mounts)
+        multiprocessing.util.Finalize(_batch_processor, _batch_processor.close, exitpriority=10)
+    
+    
+def _run_batch_worker(input_file, output_dir, run_kwargs):
+    return _batch_processor._run_batch_item(input_file, output_dir, run_kwargs)
     
     
 class FaceProcessor3DITest(FaceProcessor3DI):
-    def __init__(self, camera_model=30, landmark_model='global4', morphable_model='BFMmm-19830', fast=False, return_output=False):
+    def __init__(self, camera_model=30, landmark_model='global4', morphable_model='BFMmm-19830', basis_model='0.0.1.F591-cd-K32d', fast=False, return_output=False, timeout=None, cache_index=None, cache_budget=None, sinks=None):
+        self._config = {
+            'camera_model': camera_model,
+            'landmark_model': landmark_model,
+            'morphable_model': morphable_model,
+            'basis_model': basis_model,
+            'fast': fast,
+            'return_output': return_output,
+            'timeout': timeout,
+            'cache_index': cache_index,
+            'cache_budget': cache_budget
+        }
+        
         self.file_input = None
         self.dir_output = None
         self.execDIR = None
+        self.use_docker = False
+        self.container = None
         self.base_metadata = None
+        # outputs evicted from the cache that are not needed by the current run (see _skip_evicted)
+        self._evicted = set()
         
         self.model_camera = camera_model
         self.model_morphable = morphable_model
         self.model_landmark = landmark_model
+        self.model_basis = basis_model
         self.fast = fast
+        self.timeout = timeout
+        
+        self.cache = FileCache(index=cache_index, size_budget=cache_budget, pinned=PINNED_OUTPUTS)
         
-        self.cache = FileCache()
+        self.stage_records = MemorySink()
+        self.sinks = _sink_list(sinks)
         
         self.return_output = False
         
@@ -352,6 +1006,12 @@ class FaceProcessor3DITest(FaceProcessor3DI):
         for idx in output_file_idx:
             with open(parameters[idx], 'w') as file:
                 file.write("This is an empty file for testing purposes. Well, it is not literally 'empty' but, you know, it is not what you expect.")
+                
+        return None, None
+                
+                
+    async def _arun_command(self, executable, parameters, output_file_idx, system_call):
+        return self._run_command(executable, parameters, output_file_idx, system_call)
     
     
     
@@ -0,0 +1,104 @@
+import json
+import logging
+import threading
+
+import pandas as pd
+
+
+# Each processing step produces a record (a dictionary) with the following keys
+#   input: input video, stage: name of the step (see FaceProcessor3DI.stages)
+#   status: 'done' or 'failed', cache: 'hit' if the outputs were reused, 'miss' if they were (re)generated
+#   start: start time (seconds since epoch), wall_time and cpu_time: in seconds
+#   max_rss: peak resident memory of the command in bytes (None if not available, e.g., on Windows)
+#   input_bytes and output_bytes: total size of the input and output files
+# Records are passed to sinks, which are objects with an emit(record) method.
+
+class MemorySink:
+    # keeps the records in a list
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+
+    def emit(self, record):
+        with self._lock:
+            self.records.append(record)
+
+
+    def clear(self):
+        with self._lock:
+            self.records = []
+
+
+class JSONLinesSink:
+    # Appends each record as a line of JSON to a file. Each line is written at once to a file opened in
+    # append mode, so that many processes can write to the same file. See read_records.
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+
+    def emit(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+
+class LoggingSink:
+    # sends each record to a logger, the record itself is available to handlers as the `stage` attribute
+    def __init__(self, logger='bitbox.stages', level=logging.INFO):
+        self.logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+        self.level = level
+
+
+    def emit(self, record):
+        cpu_time = '-' if record['cpu_time'] is None else '%.2f' % record['cpu_time']
+        self.logger.log(self.level, "%s %s: %s, cache %s (wall %.2f secs, cpu %s secs)",
+                        record['input'], record['stage'], record['status'], record['cache'], record['wall_time'], cpu_time,
+                        extra={'stage': record})
+
+
+def read_records(path):
+    # records written by a JSONLinesSink
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+
+    return records
+
+
+def stage_report(records):
+    # Summary of the records per stage: number of runs, cache hits and failures, total/mean/max wall time,
+    # total cpu time, peak memory, total input and output sizes, and the share of the total wall time.
+    # Stages are sorted by their total wall time.
+    columns = ['runs', 'hits', 'failed', 'wall_time', 'wall_time_mean', 'wall_time_max', 'cpu_time', 'max_rss', 'input_bytes', 'output_bytes', 'share']
+    if len(records) == 0:
+        return pd.DataFrame(columns=columns)
+
+    data = pd.DataFrame(list(records))
+    for key in ['cpu_time', 'max_rss']:
+        data[key] = pd.to_numeric(data[key])
+    data['hit'] = data['cache'] == 'hit'
+    data['failed'] = data['status'] != 'done'
+
+    stages = data.groupby('stage', sort=False)
+    report = pd.DataFrame({
+        'runs': stages.size(),
+        'hits': stages['hit'].sum(),
+        'failed': stages['failed'].sum(),
+        'wall_time': stages['wall_time'].sum(),
+        'wall_time_mean': stages['wall_time'].mean(),
+        'wall_time_max': stages['wall_time'].max(),
+        'cpu_time': stages['cpu_time'].sum(min_count=1),
+        'max_rss': stages['max_rss'].max(),
+        'input_bytes': stages['input_bytes'].sum(),
+        'output_bytes': stages['output_bytes'].sum()
+    })
+
+    total = report['wall_time'].sum()
+    report['share'] = report['wall_time'] / total if total > 0 else 0.0
+
+    return report.sort_values('wall_time', ascending=False)[columns]
@@ -1,23 +1,74 @@
-import pandas as pd
+import os
+import itertools
+
 import numpy as np
 
-def read_rectangles(file):
-    _data = np.loadtxt(file)
-    data = pd.DataFrame(_data, columns=['x', 'y', 'w', 'h'])  
-
-    dict = {
-        'frame count': data.shape[0],
-        'format': 'for each frame (rows) [x, y, w, h] values of the detected rectangles',
-        'dimension': 2,
-        'data': data
-    }
-    
-    return dict
+from ..utilities import SignalData
+
+
+# Parsing whitespace separated text is slow for long videos. Therefore, each .3DI file gets a binary copy
+# (same name with .npy extension) that is memory-mapped in later reads. The binary copy carries the
+# modification time of the text file and is used only if the two modification times are still the same.
+def _binary_file(file):
+    return os.path.splitext(file)[0] + '.npy'
+
+
+def _is_fresh(binary_file, file):
+    try:
+        return os.stat(binary_file).st_mtime_ns == os.stat(file).st_mtime_ns
+    except OSError:
+        return False
+
+
+def save_binary(file, data=None):
+    # write the binary copy of a .3DI file, returns False if it cannot be written (e.g., read-only directory)
+    if data is None:
+        data = np.loadtxt(file)
+        
+    binary_file = _binary_file(file)
+    tmp_file = '%s.%d.tmp' % (binary_file, os.getpid())
+    try:
+        with open(tmp_file, 'wb') as f:
+            np.save(f, np.ascontiguousarray(data))
+        stat = os.stat(file)
+        os.utime(tmp_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(tmp_file, binary_file)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        return False
     
+    return True
+
+
+def _load(file, binary=True):
+    if binary:
+        binary_file = _binary_file(file)
+        if _is_fresh(binary_file, file):
+            try:
+                # copy-on-write, the values can be modified in place (as the ones loaded from the text
+                # file) without changing the binary copy
+                return np.load(binary_file, mmap_mode='c')
+            except (OSError, ValueError): # corrupted binary copy, fall back to the text file
+                pass
     
-def read_landmarks(file):
     _data = np.loadtxt(file)
     
+    if binary:
+        save_binary(file, _data)
+    
+    return _data
+
+
+def _to_rectangles(_data):
+    data = SignalData(_data, columns=['x', 'y', 'w', 'h'],
+                      format='for each frame (rows) [x, y, w, h] values of the detected rectangles',
+                      dimension=2)
+    
+    return data
+
+
+def _to_landmarks(_data):
     num_landmarks = _data.shape[1] // 2
     if num_landmarks == 51:
         schema = 'ibug51'
@@ -25,37 +76,25 @@ def read_landmarks(file):
     else:
         raise ValueError(f"Unrecognized landmark schema.")
     
-    data = pd.DataFrame(_data, columns=column_list)
-
-    dict = {
-        'frame count': data.shape[0],
-        'format': 'for each frame (rows) [x, y] values of the detected landmarks',
-        'schema': schema,
-        'dimension': 2,
-        'data': data
-    }
+    data = SignalData(_data, columns=column_list,
+                      format='for each frame (rows) [x, y] values of the detected landmarks',
+                      schema=schema,
+                      dimension=2)
     
-    return dict
+    return data
 
 
-def read_pose(file):
-    _data = np.loadtxt(file)
+def _to_pose(_data):
     #first three are translation ignore middle three last three are angles
     _data = _data[:, [0, 1, 2, 6, 7, 8]]
-    data = pd.DataFrame(_data, columns=['Tx', 'Ty', 'Tz', 'Rx', 'Ry', 'Rz'])  
+    data = SignalData(_data, columns=['Tx', 'Ty', 'Tz', 'Rx', 'Ry', 'Rz'],
+                      format='for each frame (rows) [Tx, Ty, Tz, Rx, Ry, Rz] values of the detected face pose',
+                      dimension=3)
 
-    dict = {
-        'frame count': data.shape[0],
-        'format': 'for each frame (rows) [Tx, Ty, Tz, Rx, Ry, Rz] values of the detected face pose',
-        'dimension': 3,
-        'data': data
-    }
+    return data
 
-    return dict
 
-    
-def read_expression(file):
-    _data = np.loadtxt(file)
+def _to_expression(_data):
     num_coeff = _data.shape[1]
     
     if num_coeff == 79:
@@ -82,22 +121,15 @@ def read_expression(file):
         raise ValueError(f"Unrecognized expression schema.")
       
     
-    data = pd.DataFrame(_data, columns=column_list)  
-
-    dict = {
-        'frame count': data.shape[0],
-        'format': format,
-        'schema': schema,
-        'dimension': 3,
-        'data': data
-    }
+    data = SignalData(_data, columns=column_list,
+                      format=format,
+                      schema=schema,
+                      dimension=3)
     
-    return dict
+    return data
 
 
-def read_canonical_landmarks(file):
-    _data = np.loadtxt(file)
-    
+def _to_canonical_landmarks(_data):
     num_landmarks = _data.shape[1] // 3
     if num_landmarks == 51:
         schema = 'ibug51'
@@ -105,14 +137,85 @@ def read_canonical_landmarks(file):
     else:
         raise ValueError(f"Unrecognized landmark schema.")
     
-    data = pd.DataFrame(_data, columns=column_list)
-
-    dict = {
-        'frame count': data.shape[0],
-        'format': 'for each frame (rows) [x, y, z] values of the canonicalized landmarks',
-        'schema': schema,
-        'dimension': 3,
-        'data': data
-    }
+    data = SignalData(_data, columns=column_list,
+                      format='for each frame (rows) [x, y, z] values of the canonicalized landmarks',
+                      schema=schema,
+                      dimension=3)
     
-    return dict
+    return data
+
+
+def _iter_chunks(file, chunk_frames, binary=True):
+    # yields (index of the first frame, values) for consecutive blocks of at most chunk_frames frames
+    if chunk_frames < 1:
+        raise ValueError("chunk_frames must be a positive integer.")
+    
+    if binary:
+        binary_file = _binary_file(file)
+        if _is_fresh(binary_file, file):
+            _data = np.load(binary_file, mmap_mode='c')
+            if _data.ndim == 1:
+                _data = _data.reshape(1, -1)
+            for start in range(0, _data.shape[0], chunk_frames):
+                yield start, _data[start:start+chunk_frames]
+            return
+    
+    # parse the text file block by block, only one block is kept in memory
+    start = 0
+    with open(file, 'r') as f:
+        while True:
+            lines = [l for l in itertools.islice(f, chunk_frames) if l.strip()]
+            if len(lines) == 0:
+                break
+            yield start, np.loadtxt(lines, ndmin=2)
+            start += len(lines)
+
+
+def _iter_data(file, to_data, chunk_frames, binary):
+    for start, _data in _iter_chunks(file, chunk_frames, binary=binary):
+        data = to_data(_data)
+        data['first frame'] = start
+        yield data
+
+
+def read_rectangles(file, binary=True):
+    return _to_rectangles(_load(file, binary=binary))
+
+
+def read_landmarks(file, binary=True):
+    return _to_landmarks(_load(file, binary=binary))
+
+
+def read_pose(file, binary=True):
+    return _to_pose(_load(file, binary=binary))
+
+
+def read_expression(file, binary=True):
+    return _to_expression(_load(file, binary=binary))
+
+
+def read_canonical_landmarks(file, binary=True):
+    return _to_canonical_landmarks(_load(file, binary=binary))
+
+
+# Generator versions of the read_* functions. They yield the same kind of outputs for consecutive blocks of
+# at most chunk_frames frames (with an additional 'first frame' key) so that very long recordings can be
+# processed with a bounded memory footprint. Blank lines in the text files are ignored.
+def iter_rectangles(file, chunk_frames=10000, binary=True):
+    return _iter_data(file, _to_rectangles, chunk_frames, binary)
+
+
+def iter_landmarks(file, chunk_frames=10000, binary=True):
+    return _iter_data(file, _to_landmarks, chunk_frames, binary)
+
+
+def iter_pose(file, chunk_frames=10000, binary=True):
+    return _iter_data(file, _to_pose, chunk_frames, binary)
+
+
+def iter_expression(file, chunk_frames=10000, binary=True):
+    return _iter_data(file, _to_expression, chunk_frames, binary)
+
+
+def iter_canonical_landmarks(file, chunk_frames=10000, binary=True):
+    return _iter_data(file, _to_canonical_landmarks, chunk_frames, binary)
@@ -0,0 +1,251 @@
+import os
+import sys
+import time
+import uuid
+import asyncio
+import weakref
+import threading
+import subprocess
+
+
+class CommandError(ValueError):
+    def __init__(self, message, returncode=None, log_file=None, timed_out=False):
+        super().__init__(message)
+        self.returncode = returncode
+        self.log_file = log_file
+        self.timed_out = timed_out
+
+
+def _open_log(log_file):
+    if log_file is None:
+        return subprocess.DEVNULL
+
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+
+    return open(log_file, 'w')
+
+
+def _close_log(log):
+    if log is not subprocess.DEVNULL:
+        log.close()
+
+
+def _log_tail(log_file, num_lines=5):
+    # last few lines of the log are added to the error message
+    if log_file is None or not os.path.exists(log_file):
+        return ''
+
+    with open(log_file, 'r', errors='replace') as f:
+        lines = [l.rstrip() for l in f.readlines() if l.strip()]
+
+    if len(lines) == 0:
+        return ''
+
+    return '\n' + '\n'.join(lines[-num_lines:])
+
+
+def _check_returncode(args, returncode, log_file):
+    if returncode != 0:
+        message = "Command %s exited with code %d." % (os.path.basename(str(args[0])), returncode)
+        if log_file is not None:
+            message += " See %s for details." % log_file
+        message += _log_tail(log_file)
+
+        raise CommandError(message, returncode=returncode, log_file=log_file)
+
+
+def _wait(proc, timeout=None):
+    # Wait for the process like proc.wait, but also return its resource usage as {'cpu_time': user+system
+    # seconds, 'max_rss': peak resident memory in bytes}. Only available where os.wait4 is (i.e., not on
+    # Windows), None otherwise. For docker commands, this is the usage of the docker client. The peak memory
+    # also counts the python process the command is forked from, so only large values are meaningful.
+    if not hasattr(os, 'wait4'):
+        proc.wait(timeout=timeout)
+        return None
+    
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.001
+    while True:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            raise subprocess.TimeoutExpired(proc.args, timeout)
+        time.sleep(delay)
+        delay = min(2*delay, 0.05)
+    
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    max_rss = rusage.ru_maxrss if sys.platform == 'darwin' else 1024 * rusage.ru_maxrss
+    
+    return {'cpu_time': rusage.ru_utime + rusage.ru_stime, 'max_rss': max_rss}
+
+
+def run_command(args, log_file=None, timeout=None, cwd=None):
+    # Run a command without a shell. Standard output is discarded and standard error is written to log_file.
+    # The command is killed if it does not finish within timeout seconds or if the caller is interrupted.
+    # Returns the resource usage of the command (see _wait).
+    log = _open_log(log_file)
+    try:
+        try:
+            proc = subprocess.Popen([str(a) for a in args], stdout=subprocess.DEVNULL, stderr=log, cwd=cwd)
+        except OSError as e:
+            raise CommandError("Command %s could not be started (%s)." % (args[0], e), log_file=log_file)
+
+        try:
+            usage = _wait(proc, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            raise CommandError("Command %s timed out after %s secs." % (os.path.basename(str(args[0])), timeout), log_file=log_file, timed_out=True)
+        except BaseException: # e.g., KeyboardInterrupt
+            proc.kill()
+            proc.wait()
+            raise
+    finally:
+        _close_log(log)
+
+    _check_returncode(args, proc.returncode, log_file)
+    
+    return usage
+
+
+async def arun_command(args, log_file=None, timeout=None, cwd=None):
+    # asyncio version of run_command. Cancelling the awaiting task kills the command.
+    log = _open_log(log_file)
+    try:
+        try:
+            proc = await asyncio.create_subprocess_exec(*[str(a) for a in args], stdout=subprocess.DEVNULL, stderr=log, cwd=cwd)
+        except OSError as e:
+            raise CommandError("Command %s could not be started (%s)." % (args[0], e), log_file=log_file)
+
+        try:
+            returncode = await asyncio.wait_for(proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise CommandError("Command %s timed out after %s secs." % (os.path.basename(str(args[0])), timeout), log_file=log_file, timed_out=True)
+        except BaseException: # e.g., asyncio.CancelledError
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+    finally:
+        _close_log(log)
+
+    _check_returncode(args, returncode, log_file)
+
+
+def remove_container(container):
+    # force remove a container by its id or name
+    subprocess.run(['docker', 'rm', '-f', container], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def container_name():
+    # unique name for a container started with `docker run --name` or for a process started in a persistent
+    # container. Killing the docker client does not stop either, they can then be removed/killed by their name.
+    return 'bitbox-%s' % uuid.uuid4().hex[:16]
+
+
+class PersistentContainer:
+    # A long-lived Docker container in which commands are run with `docker exec`. Starting the container
+    # and loading the image is paid once instead of once per command. The container is restarted only
+    # when a directory that is not already mounted is needed.
+    def __init__(self, image, workdir='/app/build', gpus='all'):
+        self.image = image
+        self.workdir = workdir
+        self.gpus = gpus
+        self.container_id = None
+        
+        # directories to be mounted and directories mounted by the running container
+        self.mounts = []
+        self._active_mounts = []
+
+        self._lock = threading.RLock()
+        self._finalizer = None
+
+
+    @staticmethod
+    def _is_mounted(directory, mounts):
+        for m in mounts:
+            if directory == m or directory.startswith(m.rstrip(os.sep) + os.sep):
+                return True
+        return False
+
+
+    def mount(self, directories):
+        # register directories to be mounted, takes effect when the container is (re)started
+        with self._lock:
+            for d in directories:
+                d = os.path.abspath(d)
+                if not self._is_mounted(d, self.mounts):
+                    self.mounts.append(d)
+
+
+    def ensure(self, directories=()):
+        # make sure the container is running and the given directories are mounted
+        with self._lock:
+            self.mount(directories)
+            
+            if self.container_id is not None and all([self._is_mounted(d, self._active_mounts) for d in self.mounts]):
+                return self.container_id
+
+            self.stop()
+
+            args = ['docker', 'run', '-d', '--rm', '--gpus', self.gpus]
+            for m in self.mounts:
+                args += ['-v', f"{m}:{m}"]
+            args += ['-w', self.workdir, '--entrypoint', 'sleep', self.image, 'infinity']
+
+            try:
+                result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            except OSError as e:
+                raise CommandError("Docker container could not be started (%s)." % e)
+            if result.returncode != 0 or len(result.stdout.strip()) == 0:
+                raise CommandError("Docker container could not be started (exit code %d).\n%s" % (result.returncode, result.stderr.strip()), returncode=result.returncode)
+
+            self.container_id = result.stdout.strip().splitlines()[-1]
+            self._active_mounts = list(self.mounts)
+            # remove the container even if stop() is never called
+            self._finalizer = weakref.finalize(self, remove_container, self.container_id)
+
+            return self.container_id
+
+
+    def exec_args(self, executable, name=None):
+        # command line arguments to run an executable inside the container
+        # name: if given, the process id of the executable is stored in the container so that kill(name) can
+        # stop it, killing the `docker exec` client does not stop the process inside the container
+        args = ['docker', 'exec', '-w', self.workdir, self.container_id]
+        if name is None:
+            return args + [f"./{executable}"]
+        
+        return args + ['sh', '-c', 'echo $$ > %s && exec "$@"' % self._pid_file(name), 'sh', f"./{executable}"]
+
+
+    @staticmethod
+    def _pid_file(name):
+        return '/tmp/%s.pid' % name
+
+
+    def kill(self, name):
+        # kill the process started with exec_args(executable, name), other processes running in the container
+        # (e.g., steps of other videos) are not affected
+        with self._lock:
+            container_id = self.container_id
+        if container_id is None:
+            return
+        
+        pid_file = self._pid_file(name)
+        subprocess.run(['docker', 'exec', container_id, 'sh', '-c', 'kill -9 "$(cat %s)"; rm -f %s' % (pid_file, pid_file)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+    def stop(self):
+        with self._lock:
+            if self._finalizer is not None:
+                self._finalizer()
+                self._finalizer = None
+            self.container_id = None
+            self._active_mounts = []
@@ -0,0 +1,151 @@
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Stage:
+    # A single processing step with declared input and output files. Dependencies between stages are
+    # derived from these files: a stage depends on every stage that produces one of its inputs.
+    def __init__(self, name, executable, parameters, description, output_file_idx=-1, inputs=None, resource='gpu', system_call=True):
+        if not isinstance(output_file_idx, list):
+            output_file_idx = [output_file_idx]
+
+        self.name = name
+        self.executable = executable
+        self.parameters = parameters
+        self.description = description
+        self.output_file_idx = output_file_idx
+        self.system_call = system_call
+        # resource class used to limit concurrency, e.g., 'gpu' for 3DI binaries and 'cpu' for python scripts
+        self.resource = resource
+
+        self.inputs = list(inputs) if inputs is not None else []
+        self.outputs = [parameters[idx] for idx in output_file_idx]
+
+
+    def __repr__(self):
+        return "Stage(%s)" % self.name
+
+
+def stage_dependencies(stages):
+    # map each stage to the stages that produce its inputs
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            producers[output] = stage.name
+
+    dependencies = {}
+    for stage in stages:
+        dependencies[stage.name] = set([producers[f] for f in stage.inputs if f in producers and producers[f] != stage.name])
+
+    return dependencies
+
+
+class StageScheduler:
+    # Runs the stage graphs of one or more videos on a thread pool. Stages whose dependencies are
+    # satisfied are started as soon as their resource allows it, so that independent stages of the same
+    # video (e.g., expression and pose smoothing) and stages of different videos overlap.
+    #
+    # limits: maximum number of concurrently running stages per resource class ('gpu', 'cpu') or per
+    #         stage name (e.g., {'gpu': 1, 'cpu': 4, 'smooth_expression': 2})
+    def __init__(self, limits=None):
+        self.limits = {'gpu': 1, 'cpu': os.cpu_count() or 1}
+        if limits is not None:
+            self.limits.update(limits)
+
+        for key, value in self.limits.items():
+            if int(value) < 1:
+                raise ValueError("Concurrency limit of %s must be at least 1." % key)
+
+
+    def _workers(self, jobs):
+        resources = set([stage.resource for _, stages in jobs for stage in stages])
+        num_workers = sum([self.limits.get(r, 1) for r in resources])
+
+        return max(1, num_workers)
+
+
+    def run(self, jobs, execute):
+        # jobs: list of (key, stages), key identifies the job (e.g., the processor of a video)
+        # execute: callable(key, stage) running a single stage, raising an exception on failure
+        # returns a list of {stage name: status} dictionaries and a list of error messages, one per job
+        dependencies = [stage_dependencies(stages) for _, stages in jobs]
+        status = [dict([(stage.name, 'pending') for stage in stages]) for _, stages in jobs]
+        errors = [None] * len(jobs)
+
+        running = {}
+        interrupts = []
+        lock = threading.Condition()
+
+        def _runnable(j, stage):
+            if interrupts or status[j][stage.name] != 'pending':
+                return False
+            if any([status[j][d] != 'done' for d in dependencies[j][stage.name]]):
+                return False
+            for key in (stage.resource, stage.name):
+                if key in self.limits and running.get(key, 0) >= self.limits[key]:
+                    return False
+            return True
+
+        def _skip_dependents(j):
+            # stages depending on a failed or skipped stage cannot run
+            changed = True
+            while changed:
+                changed = False
+                for name, deps in dependencies[j].items():
+                    if status[j][name] == 'pending' and any([status[j][d] in ('failed', 'skipped') for d in deps]):
+                        status[j][name] = 'skipped'
+                        changed = True
+
+        def _worker(j, stage):
+            error = None
+            try:
+                execute(jobs[j][0], stage)
+            except Exception as e:
+                error = "%s: %s" % (type(e).__name__, e)
+            except BaseException as e:
+                # e.g., KeyboardInterrupt or CancelledError, no new stages are started and the exception is
+                # re-raised once the running stages finish
+                error = "%s: %s" % (type(e).__name__, e)
+                interrupts.append(e)
+            finally:
+                with lock:
+                    running[stage.resource] -= 1
+                    running[stage.name] -= 1
+                    if error is None:
+                        status[j][stage.name] = 'done'
+                    else:
+                        status[j][stage.name] = 'failed'
+                        if errors[j] is None:
+                            errors[j] = "%s failed (%s)" % (stage.name, error)
+                        _skip_dependents(j)
+                    lock.notify_all()
+
+        with ThreadPoolExecutor(max_workers=self._workers(jobs)) as pool:
+            with lock:
+                while True:
+                    # start everything that can run, earlier videos and earlier stages first
+                    for j, (_, stages) in enumerate(jobs):
+                        for stage in stages:
+                            if _runnable(j, stage):
+                                status[j][stage.name] = 'running'
+                                running[stage.resource] = running.get(stage.resource, 0) + 1
+                                running[stage.name] = running.get(stage.name, 0) + 1
+                                pool.submit(_worker, j, stage)
+
+                    num_running = sum([s == 'running' for st in status for s in st.values()])
+                    if num_running == 0:
+                        # nothing is running and nothing could be started, i.e., we are done
+                        for j in range(len(jobs)):
+                            for name, s in status[j].items():
+                                if s == 'pending':
+                                    status[j][name] = 'skipped'
+                        break
+
+                    lock.wait()
+
+        if interrupts:
+            raise interrupts[0]
+
+        return status, errors
@@ -1,8 +1,243 @@
-def spatial_extent(landmarks):
-    print("Calculating spatial extent")
+from .utilities import get_data_values, is_stream, landmark_to_feature_mapper
+from .profiling import profiled
+import numpy as np
+import pandas as pd
 
-def speed(landmarks):
-    print("Calculating speed")
+from scipy.spatial import ConvexHull, QhullError
 
-def smoothness(landmarks):
-    print("Calculating smoothness")
\ No newline at end of file
+
+def _feature_groups(schema, num_points):
+    # landmark ids of each feature group, pose (read_pose) has no schema and its translation and rotation
+    # are treated as two 3D points
+    if schema is None:
+        if num_points != 2:
+            raise ValueError("Landmark schema is not provided.")
+        return {'translation': np.array([0]), 'rotation': np.array([1])}
+
+    groups = landmark_to_feature_mapper(schema=schema)
+    groups['overall'] = np.arange(num_points)
+
+    return groups
+
+
+def _coordinate_chunks(landmarks, axis=0):
+    # yields the schema and the (frames, landmarks, dimension) coordinates of each chunk
+    chunks = landmarks if is_stream(landmarks) else [landmarks]
+    for chunk in chunks:
+        data = get_data_values(chunk)
+
+        # whether rows are time points (axis=0) or signals (axis=1)
+        if axis == 1:
+            data = data.T
+
+        dimension = chunk['dimension']
+        if data.shape[1] % dimension != 0:
+            raise ValueError(f"Landmarks are not {dimension} dimensional. Please set the correct dimension.")
+
+        yield chunk.get('schema'), np.asarray(data, dtype=float).reshape((data.shape[0], -1, dimension))
+
+
+def _window_statistics(landmarks, axis, window, fps, order, statistics, kinds):
+    # Computes the statistics of consecutive windows (window seconds, entire recording if None) chunk by chunk.
+    # statistics(derivatives, starts) receives the coordinates and their finite difference derivatives up to
+    # order (velocity, acceleration, jerk), each (frames, landmarks, dimension) and NaN if not defined (e.g., the
+    # velocity of the first frame), and returns a tuple of per segment values for the segments starting at
+    # starts. Values of the segments of the same window (split among chunks) are merged according to kinds
+    # ('sum', 'min', 'max' or 'hull', one for each value).
+    # Only the last order frames of each chunk are kept, so the memory does not grow with the recording.
+    width = None if window is None else max(1, int(round(window * fps)))
+
+    schema = None
+    tail = None
+    first_frame = 0
+    windows = []
+    for schema, coords in _coordinate_chunks(landmarks, axis):
+        num_frames = coords.shape[0]
+        if num_frames == 0:
+            continue
+
+        # frames before the recording are NaN, hence their derivatives as well
+        if tail is None:
+            tail = np.full((order,)+coords.shape[1:], np.nan)
+        padded = np.concatenate((tail, coords))
+        tail = padded[padded.shape[0]-order:]
+
+        derivatives = [coords]
+        diff = padded
+        for _ in range(order):
+            diff = np.diff(diff, axis=0) * fps
+            derivatives.append(diff[diff.shape[0]-num_frames:])
+
+        # split the chunk at the window boundaries
+        if width is None:
+            starts = np.array([0])
+        else:
+            boundaries = np.arange((first_frame // width + 1) * width, first_frame + num_frames, width)
+            starts = np.concatenate(([0], boundaries - first_frame))
+        lengths = np.diff(np.append(starts, num_frames))
+
+        values = statistics(derivatives, starts)
+        for i, start in enumerate(starts):
+            value = tuple(v[i] for v in values)
+            window_start = 0 if width is None else (first_frame + start) // width * width
+            if len(windows) > 0 and windows[-1][0] == window_start:
+                windows[-1][1] += lengths[i]
+                windows[-1][2] = _merge(kinds, windows[-1][2], value)
+            else:
+                windows.append([window_start, lengths[i], value])
+
+        first_frame += num_frames
+
+    if len(windows) == 0:
+        raise ValueError("No landmarks are provided.")
+
+    starts, lengths, values = zip(*windows)
+
+    return schema, np.array(starts), np.array(lengths), list(values)
+
+
+def _merge(kinds, a, b):
+    # merge the statistics of two segments of the same window
+    merged = []
+    for kind, x, y in zip(kinds, a, b):
+        if kind == 'sum':
+            merged.append(x + y)
+        elif kind == 'min':
+            merged.append(np.fmin(x, y))
+        elif kind == 'max':
+            merged.append(np.fmax(x, y))
+        else:
+            merged.append([_hull_points(np.concatenate((p, q))) for p, q in zip(x, y)])
+
+    return tuple(merged)
+
+
+def _nansum_segments(values, starts):
+    # sum and number of the non-NaN values of each segment
+    valid = ~np.isnan(values)
+    return np.add.reduceat(np.where(valid, values, 0), starts, axis=0), np.add.reduceat(valid.astype(int), starts, axis=0)
+
+
+def _group_scores(scores, schema, starts):
+    # mean score of the landmarks of each feature group for each window, scores: (windows, landmarks)
+    groups = _feature_groups(schema, scores.shape[1])
+
+    valid = ~np.isnan(scores)
+    values = np.where(valid, scores, 0)
+
+    group_scores = np.full((scores.shape[0], len(groups)), np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i, idx in enumerate(groups.values()):
+            group_scores[:, i] = values[:, idx].sum(axis=1) / valid[:, idx].sum(axis=1)
+
+    return pd.DataFrame(data=group_scores, columns=list(groups.keys()), index=starts)
+
+
+def _hull_points(points):
+    # vertices of the convex hull of points (rows), which are the only points needed for the hull of a
+    # union. Degenerate points (e.g., on a plane) are joggled to find their vertices.
+    points = points[~np.isnan(points).any(axis=1)]
+    if len(points) > points.shape[1]:
+        points = np.unique(points, axis=0)
+    if len(points) <= points.shape[1]:
+        return points
+
+    for options in (None, 'QJ'):
+        try:
+            return points[ConvexHull(points, qhull_options=options).vertices]
+        except QhullError:
+            pass
+
+    return points
+
+
+def _hull_volume(points):
+    # area (2D) or volume (3D) of the convex hull, 0 for degenerate points
+    if len(points) == 0:
+        return np.nan
+    if len(points) <= points.shape[1]:
+        return 0.0
+
+    try:
+        return ConvexHull(points).volume
+    except QhullError:
+        return 0.0
+
+
+# Movement range of each landmark, i.e., the diagonal of the bounding box (method='range') or the area/volume
+# of the convex hull (method='hull') of the landmark's trajectory, averaged over the landmarks of each feature.
+# landmarks: output of read_canonical_landmarks or read_pose, or a stream of chunks (e.g., iter_canonical_landmarks)
+# window: length of consecutive windows in seconds, a row is returned for each window (first frame as index).
+# The entire recording is used if None.
+@profiled
+def spatial_extent(landmarks, axis=0, window=None, fps=30, method='range'):
+    if method == 'range':
+        def statistics(derivatives, starts):
+            coords = derivatives[0]
+            return np.fmin.reduceat(coords, starts, axis=0), np.fmax.reduceat(coords, starts, axis=0)
+    elif method == 'hull':
+        def statistics(derivatives, starts):
+            coords = derivatives[0]
+            ends = np.append(starts[1:], coords.shape[0])
+            return ([[_hull_points(coords[s:e, n]) for n in range(coords.shape[1])] for s, e in zip(starts, ends)],)
+    else:
+        raise ValueError("Invalid method: %s" % method)
+
+    kinds = ('min', 'max') if method == 'range' else ('hull',)
+    schema, starts, lengths, values = _window_statistics(landmarks, axis, window, fps, 0, statistics, kinds)
+
+    if method == 'range':
+        lower = np.stack([v[0] for v in values])
+        upper = np.stack([v[1] for v in values])
+        scores = np.sqrt(np.sum((upper - lower)**2, axis=2))
+    else:
+        scores = np.array([[_hull_volume(points) for points in v[0]] for v in values])
+
+    return _group_scores(scores, schema, starts)
+
+
+# Mean speed (magnitude of the velocity, in units per second) of each landmark, averaged over the landmarks
+# of each feature. Velocities are backward differences, thus not defined for the first frame.
+# See spatial_extent for the parameters.
+@profiled
+def speed(landmarks, axis=0, window=None, fps=30):
+    def statistics(derivatives, starts):
+        velocity = np.sqrt(np.sum(derivatives[1]**2, axis=2))
+        return _nansum_segments(velocity, starts)
+
+    schema, starts, lengths, values = _window_statistics(landmarks, axis, window, fps, 1, statistics, ('sum', 'sum'))
+
+    sums = np.stack([v[0] for v in values])
+    counts = np.stack([v[1] for v in values])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = sums / counts
+
+    return _group_scores(scores, schema, starts)
+
+
+# Smoothness of the movement of each landmark as the log dimensionless jerk
+#   -log(duration^3 / peak_speed^2 * integral of squared jerk)
+# averaged over the landmarks of each feature. Higher values are smoother movements. Jerk (the third derivative)
+# is computed with backward differences and is not defined for the first three frames.
+# See spatial_extent for the parameters.
+@profiled
+def smoothness(landmarks, axis=0, window=None, fps=30):
+    def statistics(derivatives, starts):
+        velocity = np.sqrt(np.sum(derivatives[1]**2, axis=2))
+        jerk = np.sum(derivatives[3]**2, axis=2)
+        return (np.fmax.reduceat(velocity, starts, axis=0),) + _nansum_segments(jerk, starts)
+
+    schema, starts, lengths, values = _window_statistics(landmarks, axis, window, fps, 3, statistics, ('max', 'sum', 'sum'))
+
+    peak_speed = np.stack([v[0] for v in values])
+    jerk_integral = np.stack([v[1] for v in values]) / fps
+    counts = np.stack([v[2] for v in values])
+    duration = (lengths / fps)[:, None]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = -np.log(duration**3 / peak_speed**2 * jerk_integral)
+
+    # landmarks that do not move or windows without jerk
+    scores[(counts == 0) | ~(peak_speed > 0)] = np.nan
+
+    return _group_scores(scores, schema, starts)
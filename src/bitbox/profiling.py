@@ -0,0 +1,176 @@
+import os
+import atexit
+import marshal
+import threading
+import functools
+import contextlib
+
+from time import perf_counter
+
+import pandas as pd
+
+from .utilities import SignalData, is_stream
+
+
+# Opt-in profiling of the analysis functions (expressions, kinematics, coordination, signal_processing).
+# Each decorated function records its number of calls, cumulative time (including the profiled functions it
+# calls), own time, and the shapes (frames x signals) of its input. Nothing is recorded unless profiling is
+# enabled, either for a block of code
+#
+#   with profiling.profile() as prof:
+#       expressivity(data)
+#   prof.report()
+#
+# or for the entire session with the BITBOX_PROFILE environment variable. If BITBOX_PROFILE is a file name
+# ending with .csv (flat table) or .prof (pstats, e.g., for snakeviz), the results are written there at exit.
+# When disabled, a decorated function costs one extra function call.
+
+class Profile:
+    def __init__(self):
+        self.stats = {}
+        self._lock = threading.Lock()
+
+
+    def add(self, func, elapsed, own, shape, caller, outermost):
+        # elapsed: time of this call, own: excluding the profiled functions it called, caller: profiled
+        # function that made the call (None if called directly)
+        with self._lock:
+            stat = self.stats.get(func)
+            if stat is None:
+                stat = self.stats[func] = {'calls': 0, 'time': 0.0, 'own_time': 0.0, 'shapes': {}, 'callers': {}}
+
+            stat['calls'] += 1
+            stat['own_time'] += own
+            # recursive calls (e.g., chunks of a stream) are already included in the outermost call
+            if outermost:
+                stat['time'] += elapsed
+            stat['shapes'][shape] = stat['shapes'].get(shape, 0) + 1
+            if caller is not None:
+                calls, own_time, time = stat['callers'].get(caller, (0, 0.0, 0.0))
+                stat['callers'][caller] = (calls + 1, own_time + own, time + elapsed)
+
+
+    def clear(self):
+        with self._lock:
+            self.stats = {}
+
+
+    def report(self):
+        # one row per function, sorted by cumulative time
+        columns = ['calls', 'time', 'mean_time', 'own_time', 'shapes']
+        rows = []
+        for func, stat in self.stats.items():
+            shapes = '; '.join(["%s (%d)" % (shape, count) for shape, count in sorted(stat['shapes'].items(), key=lambda s: -s[1])])
+            rows.append([stat['calls'], stat['time'], stat['time'] / stat['calls'], stat['own_time'], shapes])
+
+        report = pd.DataFrame(rows, columns=columns, index=[_name(func) for func in self.stats.keys()])
+        report.index.name = 'function'
+
+        return report.sort_values('time', ascending=False)
+
+
+    def to_csv(self, path):
+        self.report().to_csv(path)
+
+
+    def dump_stats(self, path):
+        # in the format of cProfile.Profile.dump_stats, so that the file can be loaded with pstats.Stats(path)
+        stats = {}
+        for func, stat in self.stats.items():
+            callers = {_key(caller): (calls, calls, own_time, time) for caller, (calls, own_time, time) in stat['callers'].items()}
+            stats[_key(func)] = (stat['calls'], stat['calls'], stat['own_time'], stat['time'], callers)
+
+        with open(path, 'wb') as f:
+            marshal.dump(stats, f)
+
+
+# active profiles, the decorated functions record into all of them
+_profiles = []
+_local = threading.local()
+
+
+def _name(func):
+    return '%s.%s' % (func.__module__, func.__qualname__)
+
+
+def _key(func):
+    # (file, line, name) of a function as used by pstats
+    code = func.__code__
+    return (code.co_filename, code.co_firstlineno, func.__qualname__)
+
+
+def _shape(data):
+    # frames x signals of the input, 'stream' for chunks
+    if is_stream(data):
+        return 'stream'
+
+    if isinstance(data, SignalData):
+        shape = data.values.shape
+    elif isinstance(data, dict) and 'data' in data:
+        shape = getattr(data['data'], 'shape', None)
+    else:
+        shape = getattr(data, 'shape', None)
+
+    if shape is None:
+        return type(data).__name__
+
+    return 'x'.join([str(s) for s in shape])
+
+
+def profiled(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _profiles:
+            return func(*args, **kwargs)
+
+        # profiled functions being run in this thread, with the time spent in the profiled functions they call
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+
+        outermost = all([f is not func for f, _ in stack])
+        caller = stack[-1][0] if stack else None
+        shape = _shape(args[0]) if args else None
+
+        frame = [func, 0.0]
+        stack.append(frame)
+        t0 = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = perf_counter() - t0
+            stack.pop()
+            if stack:
+                stack[-1][1] += elapsed
+            for prof in list(_profiles):
+                prof.add(func, elapsed, elapsed - frame[1], shape, caller, outermost)
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def profile():
+    # profile the analysis functions called within the block
+    prof = Profile()
+    _profiles.append(prof)
+    try:
+        yield prof
+    finally:
+        _profiles.remove(prof)
+
+
+def _write_session_profile(prof, path):
+    if path.endswith('.csv'):
+        prof.to_csv(path)
+    elif path.endswith('.prof'):
+        prof.dump_stats(path)
+
+
+# profile of the entire session, only if BITBOX_PROFILE is set
+session_profile = None
+
+_setting = os.environ.get('BITBOX_PROFILE', '')
+if _setting not in ('', '0'):
+    session_profile = Profile()
+    _profiles.append(session_profile)
+    atexit.register(_write_session_profile, session_profile, _setting)
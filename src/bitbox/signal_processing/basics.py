@@ -1,5 +1,7 @@
 import numpy as np
 
+from ..profiling import profiled
+
 def data_within_95_percent(data):
     # Sort the data
     sorted_data = np.sort(data)
@@ -15,6 +17,7 @@ def data_within_95_percent(data):
     return trimmed_data
 
 
+@profiled
 def outlier_detectionMAD(data, thresh=3.5):
     # compute median-absolute-deviation (MAD)
     median = np.median(data)
@@ -28,6 +31,7 @@ def outlier_detectionMAD(data, thresh=3.5):
     return outliers
 
 
+@profiled
 def outlier_detectionIQR(data):
     # 25 and 75 quartiles
     Q1 = np.percentile(data, 25)
@@ -45,6 +49,7 @@ def outlier_detectionIQR(data):
     
     return outliers
 
+@profiled
 def log_transform(prob, base=2):
     log_prob = np.zeros_like(prob)
     log_prob[prob>0] = np.log(prob[prob>0]) / np.log(base) 
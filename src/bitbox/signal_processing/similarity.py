@@ -1,7 +1,11 @@
-from scipy.stats import pearsonr, spearmanr
+from scipy.stats import pearsonr, spearmanr, rankdata
 import math
 import numpy as np
 
+from numpy.lib.stride_tricks import sliding_window_view
+
+from ..profiling import profiled
+
 def _xcorr(x, y, ordinal=False):   
     if ordinal:
         correlation = spearmanr
@@ -33,7 +37,8 @@ def _xcorr(x, y, ordinal=False):
     return rs
 
 
-def windowed_cross_correlation_2S(x, y, width=0.5, lag=None, step=None, fps=30, ordinal=False, negative=0):
+def window_parameters(width=0.5, lag=None, step=None, fps=30):
+    # convert window width, maximum lag, and step size from seconds to frames
     width = int(round(fps*width))
     
     if step is None:
@@ -45,6 +50,90 @@ def windowed_cross_correlation_2S(x, y, width=0.5, lag=None, step=None, fps=30,
         lag = int(width/4.)
     else:
         lag = int(round(fps*lag))
+        
+    return width, lag, step
+
+
+# maximum number of window values (windows x width x signals) built at once by the rolling engine
+_WINDOW_VALUES = 2**21
+
+def _rolling_windows(signal, width, ordinal=False, starts=None):
+    # windows (of width frames) of a signal starting at starts (all windows if None), centered and scaled to
+    # unit norm, so that the dot product of two windows is their Pearson correlation. Windows are rank
+    # transformed first for Spearman correlation. Constant windows are set to zero, their correlations are 0
+    # as in _xcorr.
+    windows = sliding_window_view(np.asarray(signal, dtype=float), width)
+    if starts is not None:
+        windows = windows[starts]
+    constant = np.all(windows == windows[:, :1], axis=1)
+    
+    if ordinal:
+        windows = rankdata(windows, axis=1)
+    
+    windows = windows - windows.mean(axis=1, keepdims=True)
+    norms = np.sqrt(np.sum(windows**2, axis=1, keepdims=True))
+    norms[constant] = 1
+    windows = windows / norms
+    windows[constant] = 0
+    
+    return windows
+
+
+def _window_blocks(offsets, step, width, lag, length, num_signals=1):
+    # Splits the window offsets into blocks such that the windows of num_signals signals needed by a block,
+    # i.e., the windows at the offsets and at their lags, fit in _WINDOW_VALUES values. The memory then does
+    # not grow with the length of the signals. Yields the range [b0, b1) of offsets of each block and the
+    # range [first, last) of the window starts it needs in a signal of length frames.
+    span = max(1, _WINDOW_VALUES // (num_signals * width))
+    count = max(1, (span - 2*lag) // max(step, 1) + 1)
+    
+    for b0 in range(0, len(offsets), count):
+        b1 = min(b0 + count, len(offsets))
+        first = max(0, offsets[b0] - lag)
+        last = min(length - width, offsets[b1-1] + max(lag, 1))
+        yield b0, b1, first, last
+
+
+def _rolling_xcorr(baseline, query_windows, first, offsets, width, lag, length):
+    # correlations of each baseline window (starting at offsets) with the query windows starting at
+    # offset-lag, ..., offset+lag-1, i.e., all the lags _xcorr evaluates for the extended query window
+    # query_windows: windows (windows, width) of the query signal starting at first, first+1, ... (see
+    #                _window_blocks), or of many query signals (signals, windows, width)
+    # returns an array (windows, 2*lag), or (signals, windows, 2*lag), with NaN for lags outside of the query
+    # signals (of length frames)
+    corrs = np.full(query_windows.shape[:-2] + (len(offsets), 2*lag), np.nan)
+    
+    for k, d in enumerate(range(-lag, lag)):
+        p = offsets + d
+        valid = (p >= 0) & (p < length - width)
+        corrs[..., valid, k] = np.sum(baseline[valid] * query_windows[..., p[valid] - first, :], axis=-1)
+    
+    return np.clip(corrs, -1, 1)
+
+
+def _max_xcorr(corrs, negative=0):
+    # maximum xcorr of each window (over the last axis of corrs, NaN values are ignored), see
+    # windowed_cross_correlation_2S
+    valid = ~np.isnan(corrs)
+    if not np.all(np.any(valid, axis=-1)):
+        raise ValueError("There are no lags to evaluate. Please increase the lag.")
+    
+    if negative==0:
+        m = np.max(np.where(valid, corrs, -np.inf), axis=-1)
+    elif negative==1:
+        idx = np.argmax(np.where(valid, np.abs(corrs), -np.inf), axis=-1)
+        m = np.take_along_axis(corrs, idx[..., None], axis=-1)[..., 0]
+    else:
+        m = np.max(np.where(valid, np.maximum(corrs, 0), -np.inf), axis=-1)
+        
+    return m
+
+
+@profiled
+def windowed_cross_correlation_2S(x, y, width=0.5, lag=None, step=None, fps=30, ordinal=False, negative=0, engine='rolling'):
+    # engine: 'rolling' computes the correlations of all windows and lags at once, 'scipy' calls
+    #         pearsonr/spearmanr for each window and lag (slow, kept for reference)
+    width, lag, step = window_parameters(width, lag, step, fps)
     
     # pick the shorter array and slide in the longer one
     if len(x) <= len(y):
@@ -55,6 +144,21 @@ def windowed_cross_correlation_2S(x, y, width=0.5, lag=None, step=None, fps=30,
         length = len(y)
         shorter = y
         longer = x
+        
+    if engine == 'rolling':
+        offsets = np.arange(0, length-width, step)
+        if len(offsets) == 0:
+            return np.array([])
+        
+        corrs = np.empty(len(offsets))
+        for b0, b1, first, last in _window_blocks(offsets, step, width, lag, len(longer), num_signals=2):
+            baseline = _rolling_windows(shorter, width, ordinal, offsets[b0:b1])
+            query = _rolling_windows(longer, width, ordinal, np.arange(first, last))
+            corrs[b0:b1] = _max_xcorr(_rolling_xcorr(baseline, query, first, offsets[b0:b1], width, lag, len(longer)), negative)
+        
+        return corrs
+    elif engine != 'scipy':
+        raise ValueError("Unknown engine %s. Please use 'rolling' or 'scipy'." % engine)
 
     corrs = []
     for n in range(0, length-width, step):
@@ -88,56 +192,106 @@ def windowed_cross_correlation_2S(x, y, width=0.5, lag=None, step=None, fps=30,
     return np.array(corrs)
 
 
-def windowed_cross_correlation(X, Y, width=0.5, lag=None, step=None, fps=30):
-    width = int(round(fps*width))
+def _normalized_windows(X, T, width, offsets):
+    # windows (windows, width, signals) of each signal, normalized as in the original per-window loop
+    windows = sliding_window_view(X[:T], width, axis=0)[offsets]
+    windows = np.ascontiguousarray(windows)
     
-    if step is None:
-        step = int(width/2.)
-    else:
-        step = int(round(fps*step))
+    mean = np.mean(windows, axis=-1, keepdims=True)
+    std = np.std(windows, axis=-1, keepdims=True)
     
-    if lag is None:
-        lag = int(width/4.)
-    else:
-        lag = int(round(fps*lag))
+    return windows, mean, std
+
+
+def _kept_lags(width, lag):
+    # indices of the full cross-correlation (of length 2*width-1) that are not overwritten with -1
+    mask = np.zeros(2*width-1, dtype=bool)
+    zero_out_frames = round((width - lag))
+    mask[0:zero_out_frames] = True
+    mask[0:round(len(mask)/2.0)] = True
+    mask[-zero_out_frames:] = True
+    
+    return np.where(~mask)[0], mask
+
+
+@profiled
+def windowed_cross_correlation(X, Y, width=0.5, lag=None, step=None, fps=30, block_size=2**22, symmetric=False):
+    Xcorr, Xlag = _windowed_cross_correlation(X, Y, width=width, lag=lag, step=step, fps=fps, block_size=block_size, symmetric=symmetric)
+    
+    # pairs of a signal with itself (same index in X and Y) are not computed
+    Sy = np.shape(X)[1] if symmetric else np.shape(Y)[1]
+    same = [i*Sy + i for i in range(min(np.shape(X)[1], Sy))]
+    Xcorr[:, same] = 0
+    Xlag[:, same] = 0
+    
+    return Xcorr, Xlag
+
+
+def _windowed_cross_correlation(X, Y, width=0.5, lag=None, step=None, fps=30, block_size=2**22, symmetric=False):
+    # For each window and each pair of signals (one from X, one from Y), the maximum of the normalized
+    # cross-correlation over the lags in [0, lag] frames and the corresponding lag in seconds.
+    # All windows are normalized at once and the correlations of all pairs are computed with one batched
+    # matrix product per lag. Windows are processed in blocks of about block_size correlation values.
+    # symmetric: X and Y are the same signals (Y is ignored), windows are extracted and normalized only once
+    width, lag, step = window_parameters(width, lag, step, fps)
+    
+    X = np.asarray(X)
+    Y = X if symmetric else np.asarray(Y)
     
     T = min((X.shape[0], Y.shape[0]))
+    Sx = X.shape[1]
+    Sy = Y.shape[1]
+    
+    offsets = np.arange(0, T-width, step)
+    Nwindows = len(offsets)
+    Xcorr = np.zeros((Nwindows, Sx*Sy))
+    Xlag  = np.zeros((Nwindows, Sx*Sy))
     
-    pairs = [(i1, i2) for i1 in range(0,X.shape[1]) for i2 in range(0,Y.shape[1])]
+    if Nwindows == 0:
+        return Xcorr, Xlag
     
-    window_offsets = range(0, T-width, step)
-    Nwindows = len(window_offsets)
-    Xcorr = np.zeros((Nwindows, len(pairs)))
-    Xlag  = np.zeros((Nwindows, len(pairs)))
+    eps = np.finfo(float).eps
+    kept, masked = _kept_lags(width, lag)
     
-    pidx = 0
-    for pidx in range(0, len(pairs)):
-        pair = pairs[pidx]
+    block = max(1, block_size // (Sx*Sy))
+    for b0 in range(0, Nwindows, block):
+        _offsets = offsets[b0:b0+block]
         
-        if pair[0] == pair[1]:
-            continue
+        x, mean, std = _normalized_windows(X, T, width, _offsets)
+        nx = ((x-mean)/(std*width+eps)).transpose(0, 2, 1)
+        if not symmetric:
+            x, mean, std = _normalized_windows(Y, T, width, _offsets)
+        ny = ((x-mean)/(std+eps)).transpose(0, 2, 1)
         
-        for tidx in range(0, Nwindows):
-            t1 = window_offsets[tidx]
-            t2 = t1
+        # running maximum over the kept lags, the first maximum wins as in np.argmax
+        best = np.full((len(_offsets), Sx, Sy), -np.inf)
+        best_idx = np.zeros(best.shape, dtype=int)
+        nans = np.zeros(best.shape, dtype=bool)
+        for k in kept:
+            m = k - (width-1)
+            n0 = max(0, -m)
+            n1 = min(width, width-m)
+            corr = np.matmul(nx[:, n0+m:n1+m, :].transpose(0, 2, 1), ny[:, n0:n1, :])
             
-            x = X[range(t1,t1+width), pair[0]]
-            y = Y[range(t2,t2+width), pair[1]]
-        
-            nx = (x-np.mean(x))/(np.std(x)*len(x)+np.finfo(float).eps)
-            ny = (y-np.mean(y))/(np.std(y)+np.finfo(float).eps)
-        
-            corr = np.correlate(nx, ny, 'full')
-        
-            zero_out_frames = round((width - lag))
-            corr[0:zero_out_frames] = -1
-            corr[0:round(len(corr)/2.0)] = -1
-            corr[-zero_out_frames:] = -1
-                                
-            maxcorr = np.max(corr)
-            maxlag = (np.argmax(corr) - round(width / 2)) / fps # in seconds
+            # np.max and np.argmax return the first NaN, if any
+            new_nans = np.isnan(corr) & ~nans
+            better = (corr > best) & ~nans
+            best[better] = corr[better]
+            best_idx[better | new_nans] = k
+            nans |= new_nans
+            
+        # lags that are overwritten with -1 take part in the maximum
+        if masked[0]: # -1 values come before the kept lags
+            below = (best <= -1) & ~nans
+            best[below] = -1
+            best_idx[below] = 0
+        elif masked[-1]:
+            below = (best < -1) & ~nans
+            best[below] = -1
+            best_idx[below] = kept[-1] + 1 # kept lags are contiguous, the masked ones follow them
+        best[nans] = np.nan
         
-            Xcorr[tidx, pidx] = maxcorr
-            Xlag[tidx, pidx] = maxlag
+        Xcorr[b0:b0+block] = best.reshape(len(_offsets), -1)
+        Xlag[b0:b0+block] = ((best_idx - round(width / 2)) / fps).reshape(len(_offsets), -1) # in seconds
             
     return Xcorr, Xlag
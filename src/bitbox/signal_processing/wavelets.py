@@ -1,9 +1,66 @@
 import numpy as np
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter, gaussian_filter1d
+from scipy.fft import rfft, irfft, next_fast_len
+from collections import OrderedDict
+import threading
 import matplotlib.pylab as plt
 
 import pywt
 
+from ..profiling import profiled
+
+class _LRUCache:
+    # small least-recently-used cache with hit/miss counters
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        
+        
+    def get(self, key, compute):
+        with self._lock:
+            if key in self._items:
+                self.hits += 1
+                self._items.move_to_end(key)
+                return self._items[key]
+            self.misses += 1
+            
+        value = compute()
+        
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                
+        return value
+    
+    
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items), 'maxsize': self.maxsize}
+    
+    
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# Mexican hat filter banks, keyed by (fps, num_scales), and their Fourier transforms, keyed by (fps, num_scales, padded length)
+_filter_banks = _LRUCache(maxsize=32)
+
+
+def filter_bank_cache_info():
+    # hits and misses of the filter bank cache, e.g., to check that repeated peak detections reuse the filters
+    return _filter_banks.info()
+
+
+def clear_filter_bank_cache():
+    _filter_banks.clear()
+
 def _value_at_percentile(data, percentile):
     # Sort the data
     sorted_data = np.sort(data)
@@ -42,15 +99,102 @@ def _peak_detector(signal, noise_removal=False):
         
     return output
 
-def _wavelet_decomposition(signal, scales):
-    # decomposition
-    cwtmatr, freqs = pywt.cwt(signal, scales, 'mexh')
+def _wavelet_decomposition(signal, fps, num_scales):
+    # decomposition and smoothing of the coefficients, using the cached filters
+    cwtmatr = _wavelet_decomposition_batch(signal[None, :], fps, num_scales)[:, 0, :]
+       
+    return cwtmatr
+
+def _compute_filters(fps, num_scales):
+    # Mexican hat filters sampled exactly as pywt.cwt does
+    scales = (fps/30) * np.geomspace(1, 18, num=num_scales)
+    int_psi, x = pywt.integrate_wavelet('mexh', precision=12)
+    step = x[1] - x[0]
+    
+    filters = []
+    for scale in scales:
+        j = (np.arange(scale * (x[-1] - x[0]) + 1) / (scale * step)).astype(int)
+        j = j[j < int_psi.size]
+        filters.append(int_psi[j][::-1])
+        
+    return scales, filters
+
+
+def _filter_bank(fps, num_scales, num_frames):
+    # filters transformed to the frequency domain with a common length so that all scales can be computed
+    # from a single transform of the signals. Lengths are rounded up to fast FFT sizes, so signals of
+    # similar lengths share the same transforms.
+    scales, filters = _filter_banks.get((fps, num_scales), lambda: _compute_filters(fps, num_scales))
+    
+    size = next_fast_len(num_frames + max([len(f) for f in filters]) - 1, real=True)
+    filters_fft = _filter_banks.get((fps, num_scales, size), lambda: [rfft(f, size) for f in filters])
+    
+    return scales, filters, filters_fft, size
+
+
+def _wavelet_decomposition_batch(signals, fps, num_scales):
+    # CWT of each row of signals (signals, frames) with the Mexican hat wavelet, the same as
+    # pywt.cwt(signal, scales, 'mexh') followed by smoothing, but for all signals at once
+    # returns an array of shape (num_scales, signals, frames); time is the last axis to keep memory access contiguous
+    num_frames = signals.shape[1]
+    scales, filters, filters_fft, size = _filter_bank(fps, num_scales, num_frames)
+    
+    signals_fft = rfft(signals, size, axis=1)
+
+    # Unlike the direct convolution of pywt.cwt, which is exactly zero where the signal is flat, the FFT leaves
+    # round-off errors there that would be detected as peaks. Coefficients below the error bound of the FFT
+    # convolution (eps * log2(size) * |signal| * |filter|) are set to zero.
+    tolerance = np.finfo(float).eps * np.log2(size) * np.sqrt(np.sum(signals**2, axis=1))
+
+    cwtmatr = np.empty((num_scales,) + signals.shape)
+    for s in range(num_scales):
+        conv = irfft(signals_fft * filters_fft[s], size, axis=1)[:, :num_frames + len(filters[s]) - 1]
+        coef = -np.sqrt(scales[s]) * np.diff(conv, axis=1)
+
+        d = (coef.shape[1] - num_frames) / 2.
+        if d > 0:
+            coef = coef[:, int(np.floor(d)):-int(np.ceil(d))]
+
+        coef[np.abs(coef) < (tolerance * np.sqrt(scales[s] * np.sum(filters[s]**2)))[:, None]] = 0
+        cwtmatr[s] = coef
     
     # smooth coefficients
-    cwtmatr = np.array([gaussian_filter(cwtmatr[s, :], sigma=1) for s in range(cwtmatr.shape[0])])
-       
+    cwtmatr = gaussian_filter1d(cwtmatr, sigma=1, axis=2)
+    
+    # constant signals have no peaks, round-off errors of the FFT should not create any
+    cwtmatr[:, np.ptp(signals, axis=1) == 0, :] = 0
+    
     return cwtmatr
 
+
+def _peak_detector_batch(wavelets, noise_removal=False):
+    # _peak_detector applied to all scales and signals of wavelets (num_scales, signals, frames) at once
+    output = np.zeros(wavelets.shape, dtype=np.int8)
+    num_frames = wavelets.shape[2]
+    
+    for sign in [1, -1]:
+        # detect all peaks/valleys where derivative changes sign
+        _d = np.maximum(sign * wavelets, 0)
+        jumps = np.diff(np.sign(np.diff(_d, axis=2)), axis=2)
+        peaks = np.zeros(wavelets.shape, dtype=bool)
+        peaks[:, :, 1:-1] = jumps == -2
+        
+        # remove tiny peaks, threshold is 10% of the 97.5th percentile of the peak magnitudes of each scale and signal
+        if noise_removal:
+            num_peaks = peaks.sum(axis=2)
+            magnitudes = np.where(peaks, np.abs(wavelets), -np.inf)
+            magnitudes.sort(axis=2)
+            index = np.minimum(np.floor(num_peaks * 97.5 / 100.0).astype(int), num_peaks - 1)
+            index = num_frames - num_peaks + np.maximum(index, 0)
+            index = np.minimum(index, num_frames - 1)
+            thresholds = np.take_along_axis(magnitudes, index[:, :, None], axis=2) * 0.1
+            peaks &= np.abs(wavelets) >= thresholds
+            
+        output[peaks] = sign
+        
+    return output
+
+
 def _visualize_peaks(signal, wavelets, peaks, fps):
     num_scales = wavelets.shape[0]
     dt = 1. / fps
@@ -76,7 +220,13 @@ def _visualize_peaks(signal, wavelets, peaks, fps):
         dx = round(seconds.max() / 40, 2)
         ax[s].set_xticks(np.arange(0, seconds.max()+dx, dx))
 
+@profiled
 def peak_detection(data, num_scales=6, fps=30, smooth=True, noise_removal=False, visualize=False):
+    # a 2D array (frames, signals) is processed in a single batch
+    # returns an array of shape (num_scales, frames, signals) with 1 for peaks, -1 for valleys, and 0 otherwise
+    if isinstance(data, np.ndarray) and data.ndim == 2:
+        return _peak_detection_batch(data, num_scales=num_scales, fps=fps, smooth=smooth, noise_removal=noise_removal, visualize=visualize)
+    
     # check if the data is a list
     if not isinstance(data, list):
         datal = [data]
@@ -96,8 +246,7 @@ def peak_detection(data, num_scales=6, fps=30, smooth=True, noise_removal=False,
             signal = gaussian_filter(signal, sigma=1)
         
         # wavelet decomposition at multiple scales
-        scales = (fps/30) * np.geomspace(1, 18, num=num_scales)      
-        wavelets = _wavelet_decomposition(signal, scales)
+        wavelets = _wavelet_decomposition(signal, fps, num_scales)
         
         # peak detection at different scales
         peaks = np.zeros_like(wavelets)
@@ -112,4 +261,32 @@ def peak_detection(data, num_scales=6, fps=30, smooth=True, noise_removal=False,
     if not isinstance(data, list):
         peaksl = peaksl[0]
     
-    return peaksl
\ No newline at end of file
+    return peaksl
+
+
+def _peak_detection_batch(data, num_scales=6, fps=30, smooth=True, noise_removal=False, visualize=False):
+    # zero mean the signals, one signal per row
+    signals = np.ascontiguousarray((data - data.mean(axis=0)).T)
+    
+    # smooth the signals
+    if smooth:
+        signals = gaussian_filter1d(signals, sigma=1, axis=1)
+        
+    # signals are processed in blocks whose coefficients (about 4MB) fit in the cache
+    num_signals, num_frames = signals.shape
+    block = max(1, 2**22 // (8 * num_scales * num_frames))
+    
+    peaks = np.empty((num_scales, num_frames, num_signals), dtype=np.int8)
+    for b0 in range(0, num_signals, block):
+        # wavelet decomposition at multiple scales
+        wavelets = _wavelet_decomposition_batch(signals[b0:b0+block], fps, num_scales)
+        
+        # peak detection at different scales
+        _peaks = _peak_detector_batch(wavelets, noise_removal=noise_removal)
+        peaks[:, :, b0:b0+block] = _peaks.transpose(0, 2, 1)
+        
+        if visualize:
+            for i in range(_peaks.shape[1]):
+                _visualize_peaks(data[:, b0+i], wavelets[:, i, :], _peaks[:, i, :], fps)
+    
+    return peaks
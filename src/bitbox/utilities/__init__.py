@@ -1,3 +1,3 @@
-from .caching import FileCache
-from .file_types import get_data_values
+from .caching import FileCache, CacheIndex
+from .file_types import get_data_values, is_stream, SignalData
 from .landmarks import landmark_to_feature_mapper
\ No newline at end of file
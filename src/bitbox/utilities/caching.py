@@ -1,6 +1,10 @@
 import os
+import re
 import json
 import glob
+import sqlite3
+import hashlib
+import threading
 
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
@@ -14,17 +18,271 @@ def parse_retention_period(period_str):
     return retention_period_timedelta
 
 
+def parse_size(size):
+    # size in bytes from an integer or a string such as '500 MB' or '2 GB'
+    if isinstance(size, (int, float)):
+        return int(size)
+    
+    units = {'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4}
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?B)?\s*', size.upper())
+    if match is None:
+        raise ValueError("Unrecognized size %s. Please use a number followed by one of %s." % (size, list(units.keys())))
+    
+    return int(float(match.group(1)) * units[match.group(2) or 'B'])
+
+
+def format_size(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+        
+    return "%.1f TB" % size
+
+
+def hash_file(file_path, chunk_size=4*1024*1024):
+    # blake2b digest of the file content, read in chunks
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+            
+    return h.hexdigest()
+
+
+def metadata_file(file_path):
+    return '.'.join(file_path.split('.')[:-1]) + '.json'
+
+
+def _read_json(json_file):
+    if not os.path.exists(json_file):
+        return None
+    
+    with open(json_file, "r") as f:
+        return json.load(f)
+
+
+class CacheIndex:
+    # A single SQLite database holding the metadata of many cached files. It replaces the JSON file
+    # stored next to each output, which is slow on network file systems when there are thousands of
+    # outputs, and it allows querying the metadata of many files with one read.
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        
+        
+    def _connect(self):
+        # connections cannot be shared with forked processes, each process opens its own
+        if self._connection is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            
+            connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            connection.execute("CREATE TABLE IF NOT EXISTS metadata (path TEXT PRIMARY KEY, directory TEXT NOT NULL, metadata TEXT NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS metadata_directory ON metadata (directory)")
+            connection.commit()
+            
+            self._connection = connection
+            self._pid = os.getpid()
+            
+        return self._connection
+    
+    
+    def __getstate__(self):
+        return {'path': self.path}
+    
+    
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+        
+    
+    def get(self, file_path):
+        return self.get_many([file_path])[file_path]
+    
+    
+    def get_many(self, file_paths):
+        # metadata of many files at once, None for the files without metadata
+        keys = dict([(os.path.abspath(f), f) for f in file_paths])
+        results = dict([(f, None) for f in file_paths])
+        
+        # SQLite limits the number of parameters of a query
+        paths = list(keys.keys())
+        with self._lock:
+            connection = self._connect()
+            for i in range(0, len(paths), 500):
+                batch = paths[i:i+500]
+                query = "SELECT path, metadata FROM metadata WHERE path IN (%s)" % ','.join(['?'] * len(batch))
+                for path, metadata in connection.execute(query, batch):
+                    results[keys[path]] = json.loads(metadata)
+                    
+        return results
+    
+    
+    def get_tree(self, directory):
+        # metadata of all files in a directory and its subdirectories
+        prefix = os.path.join(os.path.abspath(directory), '')
+        with self._lock:
+            rows = self._connect().execute("SELECT path, metadata FROM metadata WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)).fetchall()
+            
+        return dict([(path, json.loads(metadata)) for path, metadata in rows])
+    
+    
+    def get_directory(self, directory):
+        # metadata of all files in a directory
+        with self._lock:
+            rows = self._connect().execute("SELECT path, metadata FROM metadata WHERE directory = ?", (os.path.abspath(directory),)).fetchall()
+            
+        return dict([(path, json.loads(metadata)) for path, metadata in rows])
+    
+    
+    def put(self, file_path, metadata):
+        self.put_many({file_path: metadata})
+        
+        
+    def put_many(self, records):
+        # records: metadata of each file, written in a single transaction
+        rows = [(os.path.abspath(f), os.path.dirname(os.path.abspath(f)), json.dumps(m)) for f, m in records.items()]
+        with self._lock:
+            connection = self._connect()
+            connection.executemany("INSERT OR REPLACE INTO metadata (path, directory, metadata) VALUES (?, ?, ?)", rows)
+            connection.commit()
+            
+            
+    def delete(self, file_path):
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM metadata WHERE path = ?", (os.path.abspath(file_path),))
+            connection.commit()
+
+
 class FileCache:
-    def __init__(self, json_required=True, retention_period='6 months'):
+    def __init__(self, json_required=True, retention_period='6 months', content_hash=True, index=None, size_budget=None, pinned=None):
         self.json_required = json_required
         self.retention_period = parse_retention_period(retention_period)
+        
+        # maximum total size of the cached files under an output directory (see gc), None for no limit
+        self.size_budget = parse_size(size_budget) if size_budget is not None else None
+        # files whose names (without extension) end with one of these are never evicted by gc
+        self.pinned = list(pinned) if pinned is not None else []
+        
+        # optional SQLite database (path or CacheIndex) storing the metadata instead of JSON files
+        if index is not None and not isinstance(index, CacheIndex):
+            index = CacheIndex(index)
+        self.index = index
+        
+        # whether content hashes of the input files are recorded and compared
+        self.content_hash = content_hash
+        # content hashes computed so far, keyed by (path, size, modification time)
+        self._hashes = {}
+        
+        
+    def file_hash(self, file_path):
+        stat = os.stat(file_path)
+        key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        if key not in self._hashes:
+            self._hashes[key] = hash_file(file_path)
+            
+        return self._hashes[key]
+    
     
+    def _input_record(self, file_path):
+        stat = os.stat(file_path)
+        record = {
+            'path': os.path.abspath(file_path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'hash': self.file_hash(file_path)
+        }
+        
+        return record
+    
+    
+    def inputs_changed(self, old_metadata, inputs):
+        # Compare the inputs with the input hashes recorded in the metadata. Recorded hashes are reused
+        # when the size and the modification time of an input are unchanged, so large videos are not
+        # hashed on every run. Inputs that no longer exist (e.g., deleted intermediate files) are skipped.
+        if not self.content_hash or inputs is None or 'input_hashes' not in old_metadata:
+            return False
+        
+        records = dict([(r['path'], r) for r in old_metadata['input_hashes']])
+        for file_path in inputs:
+            if not os.path.exists(file_path):
+                continue
+            
+            path = os.path.abspath(file_path)
+            if path not in records:
+                return True
+            
+            stat = os.stat(file_path)
+            if stat.st_size != records[path]['size']:
+                return True
+            if stat.st_mtime_ns == records[path]['mtime']:
+                continue
+            if self.file_hash(file_path) != records[path]['hash']:
+                return True
+            
+        return False
     
-    def check_file(self, file_path, current_metadata=None, verbose=False, json_required=None, retention_period=None):
+    
+    def read_metadata(self, file_path):
+        # metadata stored for a file, None if there is no metadata
+        return self.read_metadata_many([file_path])[file_path]
+        
+        
+    def read_metadata_many(self, file_paths):
+        # metadata of many files, read from the index at once if there is one
+        if self.index is None:
+            return dict([(f, _read_json(metadata_file(f))) for f in file_paths])
+        
+        metadata = self.index.get_many(file_paths)
+        
+        # files cached before the index was used only have JSON files, their metadata is imported into the index
+        imported = {}
+        for f in file_paths:
+            if metadata[f] is None:
+                metadata[f] = _read_json(metadata_file(f))
+                if metadata[f] is not None:
+                    imported[f] = metadata[f]
+        if len(imported) > 0:
+            self.index.put_many(imported)
+            
+        return metadata
+    
+    
+    def check_file(self, file_path, current_metadata=None, verbose=False, json_required=None, retention_period=None, inputs=None):
+        old_metadata = self.read_metadata(file_path)
+        
+        return self._check_file(file_path, old_metadata, current_metadata, verbose, json_required, retention_period, inputs)
+    
+    
+    def check_files(self, file_paths, current_metadata=None, verbose=False, json_required=None, retention_period=None, inputs=None):
+        # check_file for many files with a single read of the metadata index
+        # inputs: None or a list with the inputs of each file
+        if inputs is None:
+            inputs = [None] * len(file_paths)
+            
+        metadata = self.read_metadata_many(file_paths)
+        
+        status = []
+        for file_path, _inputs in zip(file_paths, inputs):
+            status.append(self._check_file(file_path, metadata[file_path], current_metadata, verbose, json_required, retention_period, _inputs))
+            
+        return status
+    
+    
+    def _check_file(self, file_path, old_metadata, current_metadata=None, verbose=False, json_required=None, retention_period=None, inputs=None):
         # Return codes:
         # 0: file exists no need to create a new file
         # 1: file does not exist, create a new file
         # 2: file does not exist, create a new file with a new name
+        # 3: file was evicted by gc, create a new file only if it is needed
         
         # @TODO: check if the file is a valid file
         
@@ -40,12 +298,8 @@ class FileCache:
         
         # check if the file exists
         if os.path.exists(file_path): # file exists
-            # check if the associated JSON file exists
-            json_file = '.'.join(file_path.split('.')[:-1]) + '.json'
-            if os.path.exists(json_file): # JSON exits
-                with open(json_file, "r") as json_file:
-                    old_metadata = json.load(json_file)
-                    
+            # check if the associated JSON file (or index record) exists
+            if old_metadata is not None: # JSON exits
                 # compare metadata
                 same = True
                 for key, value in current_metadata.items():
@@ -54,8 +308,13 @@ class FileCache:
                             same = False
                             break           
                         
+                # check if the inputs have changed since the file was generated
+                if same and self.inputs_changed(old_metadata, inputs):
+                    if verbose:
+                        print("An older file, %s, is found with the same metadata, but its inputs have changed. A new file will be generated." % file_name)
+                    status = 2
                 # check if the metadata is the same        
-                if same: # same metadata
+                elif same: # same metadata
                     # check the retention period
                     if 'time' in old_metadata:
                         time_created = datetime.strptime(old_metadata['time'], "%Y-%m-%d %H:%M:%S")
@@ -97,17 +356,37 @@ class FileCache:
                         if verbose:
                             print("A recent file, %s, is found with missing JSON file. Old file will be used." % file_name)
                         status = 0
+        elif old_metadata is not None and 'evicted' in old_metadata: # file was deleted by gc
+            same = all([old_metadata[key] == value for key, value in current_metadata.items() if key in old_metadata])
+            if same and not self.inputs_changed(old_metadata, inputs):
+                if verbose:
+                    print("%s was evicted from the cache. A new file will be generated if it is needed." % file_name)
+                status = 3
+            else:
+                if verbose:
+                    print("%s was evicted from the cache and its metadata or inputs have changed. A new file will be generated." % file_name)
+                status = 2
         else: # file does not exist
             status = 1
                 
         return status
     
     
-    def store_metadata(self, file_path, base_metadata):
+    def store_metadata(self, file_path, base_metadata, inputs=None):
         additonial_metadata = {'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        if self.content_hash and inputs is not None:
+            additonial_metadata['input_hashes'] = [self._input_record(f) for f in inputs if os.path.exists(f)]
         metadata = {**base_metadata, **additonial_metadata}
         
-        json_path = '.'.join(file_path.split('.')[:-1]) + '.json'
+        self.write_metadata(file_path, metadata)
+        
+        
+    def write_metadata(self, file_path, metadata):
+        if self.index is not None:
+            self.index.put(file_path, metadata)
+            return
+        
+        json_path = metadata_file(file_path)
         with open(json_path, "w") as f:
             json.dump(metadata, f, indent=4)
             
@@ -132,7 +411,10 @@ class FileCache:
     
     
     def delete_old_metadata(self, file_path):
-        json_file = '.'.join(file_path.split('.')[:-1]) + '.json'
+        if self.index is not None:
+            self.index.delete(file_path)
+        
+        json_file = metadata_file(file_path)
         if os.path.exists(json_file):
             os.remove(json_file)
             
@@ -152,4 +434,127 @@ class FileCache:
         self.delete_old_metadata(file_path)
         
     def change_retention_period(self, retention_period):
-        self.retention_period = parse_retention_period(retention_period)
\ No newline at end of file
+        self.retention_period = parse_retention_period(retention_period)
+        
+        
+    def touch(self, file_path):
+        # record that a cached file is used, gc evicts the files that were not used for the longest time
+        metadata = self.read_metadata(file_path)
+        if metadata is None:
+            return
+        
+        metadata['last_access'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.write_metadata(file_path, metadata)
+        
+        
+    def evict(self, file_path):
+        # Delete a cached file (and its binary copy) but keep its metadata, marked as evicted, so that the
+        # file is known to be deleted on purpose (see _check_file) rather than missing
+        metadata = self.read_metadata(file_path)
+        
+        for f in [file_path, os.path.splitext(file_path)[0] + '.npy']:
+            if os.path.exists(f):
+                os.remove(f)
+            if os.path.exists(f):
+                raise ValueError("Old file could not be deleted.")
+            
+        if metadata is not None:
+            metadata['evicted'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.write_metadata(file_path, metadata)
+        
+        
+    def _cached_files(self, directory):
+        # cached files (i.e., files with metadata) under a directory and their metadata
+        if self.index is not None:
+            records = self.index.get_tree(directory)
+            return dict([(f, m) for f, m in records.items() if os.path.exists(f)])
+        
+        records = {}
+        for root, _, files in os.walk(directory):
+            names = set(files)
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                
+                # the cached file has the same name as its JSON file, with a different extension
+                base = name[:-len('.json')]
+                matches = [f for f in names if f.startswith(base + '.') and os.path.splitext(f)[1] not in ('.json', '.npy', '.tmp')]
+                if len(matches) != 1:
+                    continue
+                
+                try:
+                    with open(os.path.join(root, name), 'r') as f:
+                        metadata = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                
+                if isinstance(metadata, dict) and 'time' in metadata:
+                    records[os.path.join(root, matches[0])] = metadata
+                    
+        return records
+    
+    
+    def _last_access(self, file_path, metadata):
+        for key in ('last_access', 'time'):
+            if key in metadata:
+                return datetime.strptime(metadata[key], "%Y-%m-%d %H:%M:%S").timestamp()
+            
+        return os.path.getmtime(file_path)
+    
+    
+    def is_pinned(self, file_path):
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        
+        return any([name.endswith(p) for p in self.pinned])
+        
+        
+    def gc(self, directory, size_budget=None, dry_run=False, verbose=True):
+        # Evict cached files under a directory, least recently used first, until their total size (including
+        # binary copies) fits in the size budget. Pinned files are never evicted. The metadata of the evicted
+        # files is kept so that they are not regenerated unless they are needed (see evict).
+        # Returns a report with the reclaimed space in bytes and the deleted files.
+        if size_budget is None:
+            size_budget = self.size_budget
+        else:
+            size_budget = parse_size(size_budget)
+            
+        if size_budget is None:
+            raise ValueError("No size budget is given. Please set size_budget.")
+        
+        entries = []
+        total_size = 0
+        for file_path, metadata in self._cached_files(directory).items():
+            # the binary copy is deleted along with the cached file
+            size = sum([os.path.getsize(f) for f in [file_path, os.path.splitext(file_path)[0] + '.npy'] if os.path.exists(f)])
+            total_size += size
+            
+            if not self.is_pinned(file_path):
+                entries.append((self._last_access(file_path, metadata), file_path, size))
+                
+        entries.sort()
+        
+        reclaimed = 0
+        deleted = []
+        for _, file_path, size in entries:
+            if total_size - reclaimed <= size_budget:
+                break
+            
+            if not dry_run:
+                self.evict(file_path)
+                        
+            reclaimed += size
+            deleted.append(file_path)
+            
+        report = {
+            'reclaimed': reclaimed,
+            'deleted': deleted,
+            'size': total_size - reclaimed
+        }
+        
+        if verbose:
+            action = "Would reclaim %s by deleting" if dry_run else "Reclaimed %s by deleting"
+            print((action + " %d cached files in %s (%s remaining)") % (format_size(reclaimed), len(deleted), directory, format_size(report['size'])))
+            if report['size'] > size_budget:
+                print("Remaining files exceed the size budget of %s, the rest of the files are pinned." % format_size(size_budget))
+            
+        return report
\ No newline at end of file
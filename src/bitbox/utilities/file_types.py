@@ -1,7 +1,73 @@
 import numpy as np
 import pandas as pd
 
+from collections.abc import MutableMapping, Iterator
+
+
+class SignalData(MutableMapping):
+    # Result of the read_* functions. It behaves like the dictionary these functions used to return
+    # ('frame count', 'format', 'schema', 'dimension', 'data'), but it keeps the values as a (possibly
+    # memory-mapped) array and creates the 'data' DataFrame only when it is accessed.
+    __slots__ = ('values', 'columns', '_info', '_frame')
+    
+    def __init__(self, values, columns, **info):
+        self.values = values
+        self.columns = list(columns)
+        self._info = {'frame count': values.shape[0], **info}
+        self._frame = None
+        
+        
+    def __getitem__(self, key):
+        if key == 'data':
+            if self._frame is None:
+                self._frame = pd.DataFrame(self.values, columns=self.columns, copy=False)
+            return self._frame
+        
+        return self._info[key]
+    
+    
+    def __setitem__(self, key, value):
+        if key == 'data':
+            value = pd.DataFrame(value)
+            self.values = value.values
+            self.columns = list(value.columns)
+            self._info['frame count'] = value.shape[0]
+            self._frame = value
+        else:
+            self._info[key] = value
+            
+            
+    def __delitem__(self, key):
+        if key in ('data', 'frame count'):
+            raise KeyError("%s cannot be deleted" % key)
+        
+        del self._info[key]
+        
+        
+    def __iter__(self):
+        yield from self._info
+        yield 'data'
+        
+        
+    def __len__(self):
+        return len(self._info) + 1
+    
+    
+    def __repr__(self):
+        info = ', '.join(["'%s': %r" % (k, v) for k, v in self._info.items()])
+        return "SignalData({%s, 'data': <%d x %d %s>})" % (info, self.values.shape[0], len(self.columns), self.values.dtype)
+
+
+def is_stream(data):
+    # whether data is given as consecutive chunks of frames (e.g., by reader3DI.iter_expression)
+    return isinstance(data, Iterator)
+
+
 def get_data_values(data):
+    # results of the read_* functions are returned as zero-copy views
+    if isinstance(data, SignalData):
+        return data.values
+    
     # check if data is a dictionary
     if isinstance(data, dict):
         data = dictionary_to_array(data)
@@ -14,4 +80,4 @@ def dictionary_to_array(data):
         if 'data' in data and isinstance(data['data'], pd.DataFrame):
             return data['data'].values
     
-    raise ValueError("Unrecognized data type")
\ No newline at end of file
+    raise ValueError("Unrecognized data type")
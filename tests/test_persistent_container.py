@@ -0,0 +1,138 @@
+import os
+import sys
+import stat
+import warnings
+
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from bitbox.face_backend import backend3DI
+from bitbox.face_backend.backend3DI import FaceProcessor3DI, _init_batch_worker
+from bitbox.face_backend.runner import PersistentContainer, CommandError, run_command
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason="the fake docker is a shell script")
+
+
+# Fake docker client that records its arguments, one invocation per line. `docker run -d` prints a new
+# container id (c1, c2, ...), 3DI executables take $DOCKER_SLEEP seconds (if set), other commands succeed
+# without doing anything.
+_DOCKER = """#!/bin/sh
+echo "$@" >> "$DOCKER_LOG"
+if [ "$1" = "run" ]; then
+    echo "c$(grep -c '^run ' "$DOCKER_LOG")"
+fi
+case "$*" in
+    *./video_*) if [ -n "$DOCKER_SLEEP" ]; then sleep "$DOCKER_SLEEP"; fi ;;
+esac
+"""
+
+
+@pytest.fixture
+def docker(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    shim = bin_dir / 'docker'
+    shim.write_text(_DOCKER)
+    shim.chmod(shim.stat().st_mode | stat.S_IEXEC)
+
+    log = tmp_path / 'docker.log'
+    monkeypatch.setenv('DOCKER_LOG', str(log))
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('DOCKER_3DI', 'image')
+
+    def calls():
+        return log.read_text().splitlines() if log.exists() else []
+
+    return calls
+
+
+def _run(mounts):
+    # docker run that starts the persistent container with the given mounts
+    args = 'run -d --rm --gpus all'
+    for m in mounts:
+        args += ' -v %s:%s' % (m, m)
+    return args + ' -w /app/build --entrypoint sleep image infinity'
+
+
+def test_start_exec_and_remount(docker, tmp_path):
+    a = str(tmp_path / 'a')
+    b = str(tmp_path / 'b')
+    container = PersistentContainer('image')
+
+    # started once, mounted directories (and their subdirectories) do not restart it
+    assert container.ensure([a]) == 'c1'
+    assert container.ensure([a, os.path.join(a, 'video')]) == 'c1'
+    assert docker() == [_run([a])]
+
+    run_command(container.exec_args('video_detect_face') + ['input.mp4'])
+    assert docker()[-1] == 'exec -w /app/build c1 ./video_detect_face input.mp4'
+
+    # a named process stores its id so that it can be killed without removing the container
+    run_command(container.exec_args('video_detect_face', name='step') + ['input.mp4'])
+    assert docker()[-1] == 'exec -w /app/build c1 sh -c echo $$ > /tmp/step.pid && exec "$@" sh ./video_detect_face input.mp4'
+    container.kill('step')
+    assert docker()[-1] == 'exec c1 sh -c kill -9 "$(cat /tmp/step.pid)"; rm -f /tmp/step.pid'
+
+    # a new directory restarts the container with all the directories mounted
+    assert container.ensure([b]) == 'c2'
+    assert docker()[-2:] == ['rm -f c1', _run([a, b])]
+
+    container.stop()
+    container.stop()
+    assert docker()[-1] == 'rm -f c2'
+    assert docker().count('rm -f c2') == 1
+
+
+def test_processor_removes_container_on_exit(docker, tmp_path):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with FaceProcessor3DI(persistent_container=True) as processor:
+            processor.container.ensure([str(tmp_path)])
+
+    assert docker() == [_run([str(tmp_path)]), 'rm -f c1']
+
+    # close() can be called again
+    processor.close()
+    assert docker()[-1] == 'rm -f c1'
+    assert len(docker()) == 2
+
+
+def test_timeout_kills_only_the_step(docker, tmp_path, monkeypatch):
+    monkeypatch.setenv('DOCKER_SLEEP', '5')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        processor = FaceProcessor3DI(persistent_container=True, timeout=0.5)
+    processor.file_input = str(tmp_path / 'video.mp4')
+    processor.file_input_base = 'video'
+    processor.dir_output = str(tmp_path)
+
+    with pytest.raises(CommandError) as error:
+        processor._run_command('video_detect_face', [processor.file_input], 0, True)
+    assert error.value.timed_out
+
+    # the process of the step is killed, the container shared with other steps keeps running
+    calls = docker()
+    assert calls[0] == _run([str(tmp_path)])
+    name = calls[1].split('/tmp/')[1].split('.pid')[0]
+    assert calls[1:] == ['exec -w /app/build c1 sh -c echo $$ > /tmp/%s.pid && exec "$@" sh ./video_detect_face %s' % (name, processor.file_input),
+                         'exec c1 sh -c kill -9 "$(cat /tmp/%s.pid)"; rm -f /tmp/%s.pid' % (name, name)]
+    assert processor.container.container_id == 'c1'
+
+    processor.close()
+    assert docker()[-1] == 'rm -f c1'
+
+
+def _start_worker_container(directory):
+    return backend3DI._batch_processor.container.ensure([directory])
+
+
+def test_batch_worker_removes_container_on_exit(docker, tmp_path):
+    config = {'persistent_container': True, 'return_output': False}
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with ProcessPoolExecutor(max_workers=1, initializer=_init_batch_worker, initargs=(FaceProcessor3DI, config, [str(tmp_path)])) as pool:
+            container_id = pool.submit(_start_worker_container, str(tmp_path)).result()
+
+    # the worker removes its container when it exits
+    assert docker() == [_run([str(tmp_path)]), 'rm -f %s' % container_id]